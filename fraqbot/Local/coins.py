@@ -1,12 +1,21 @@
+from bisect import bisect_left
+from collections import Counter
+from collections import deque
 from datetime import datetime
 from datetime import timedelta
+from heapq import heapify
+from heapq import heappop
+from heapq import merge
+from itertools import islice
 import json
 import logging
 import os
 from random import choice
+from random import expovariate
 from random import randint
 import re
 import sys
+import threading
 
 from pytz import timezone
 
@@ -15,13 +24,72 @@ LOCAL_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)))
 sys.path.append(LOCAL_DIR)
 
 
+from helpers.coins import account_locks  # noqa: E402
 from helpers.coins import CoinsBase  # noqa: E402
+from helpers.coins import SecretWordMatcher  # noqa: E402
+from helpers.scheduler import get_scheduler  # noqa: E402
 from helpers import text  # noqa: E402
 from helpers import utils  # noqa: E402
 
 
 LOGGER = logging.getLogger(__name__)
 CHOICES = (False, True, False, True, False)
+DEDUPE_OVERLAP = 3 * 86400
+HISTORY_PAGE_SIZE = 15
+MAX_WORD_PERIODS = 10
+MAX_USER_CANDIDATES = 1000
+USER_ID = re.compile(r'^U[A-Z0-9]{8,10}$')
+# Emoji, mentions and dotted strings (URLs, filenames) are matched ahead of
+# words so that a single scan both tokenizes and drops them.
+CANDIDATE_TOKENS = re.compile(
+    r'(:[a-zA-Z0-9_-]+:)|<@U[A-Z0-9]+>|\S+\.\S+|\b(\w{4,})\b')
+CANDIDATE_SKIP = re.compile(r'^!ak|(?i:moin)')
+POOL_TZ = timezone('US/Eastern')
+POOL_FILLUP_TIME = (8, 30)
+POOL_RETRY = 300
+PARTICIPANT_FLUSH = 60
+NON_PARTICIPANT_SUBTYPES = (
+    'bot_message', 'message_changed', 'message_deleted')
+DAILY = {'field': 'tx_timestamp', 'bucket': 86400, 'name': 'day'}
+REPORTS = {
+    'payees': {
+        'title': 'Top payees',
+        'headers': {'payee_id': 'User', 'total': 'Total', 'txs': 'Txs'},
+        'user_id_field': 'payee_id',
+        'query': {
+            'group_by': 'payee_id',
+            'metrics': {'total': ('sum', 'amount'), 'txs': ('count', '*')},
+            '_filter': {'payee_id__op': {'startswith': 'U'}},
+            'sort': 'total,desc',
+            'limit': 10
+        }
+    },
+    'tips': {
+        'title': 'Tips per day',
+        'headers': {'day': 'Day', 'tips': 'Tips', 'total': 'Total'},
+        'query': {
+            'group_by': DAILY,
+            'metrics': {'tips': ('count', '*'), 'total': ('sum', 'amount')},
+            '_filter': {
+                'payer_id__op': {'startswith': 'U'},
+                'payee_id__op': {'startswith': 'U'}
+            },
+            'sort': 'day,desc',
+            'limit': 14
+        }
+    },
+    'pool': {
+        'title': 'Pool payouts per day',
+        'headers': {'day': 'Day', 'payees': 'Payees', 'total': 'Total'},
+        'query': {
+            'group_by': DAILY,
+            'metrics': {'payees': ('count', '*'), 'total': ('sum', 'amount')},
+            '_filter': {'payer_id': 'pool'},
+            'sort': 'day,desc',
+            'limit': 14
+        }
+    }
+}
 
 
 class Coins(CoinsBase):
@@ -33,16 +101,25 @@ class Coins(CoinsBase):
         lines.append(f'    • To give coins: `{triggers} tip|pay <user> '
                      '<int> [<optional memo>]`')
         lines.append(f'    • To see when the pool resets: `{triggers} pool`')
+        lines.append('    • To see your transactions, newest first: '
+                     f'`{triggers} history [<before id>]`')
         lines.append('\n    • *Admin functions:*')
         lines.append(f'        • To see all balances: `{triggers} balances`')
         lines.append(
             f'        • To see current escrow (DM only): `{triggers} escrow`')
         lines.append('        • To see other user\'s balances (DM only): '
                      f'`{triggers} user_balance <user>`')
-        lines.append('        • To dedupe moin payouts: '
-                     f'`{triggers} dedupe [<user>]`')
+        lines.append('        • To dedupe moin payouts since the last run, '
+                     'from the start (all) or for a user: '
+                     f'`{triggers} dedupe [all|<user>]`')
         lines.append('        • To transfer (e.g. to unpay fraqbot): '
                      f'`{triggers} transfer <user> <user> [<int>]`')
+        lines.append('        • To see or reset the balance cache (DM only): '
+                     f'`{triggers} cache [reset]`')
+        lines.append('        • To see ledger write queue stats (DM only): '
+                     f'`{triggers} writes`')
+        lines.append('        • To see a ledger report (DM only): '
+                     f'`{triggers} report payees|tips|pool`')
 
         return '\n'.join(lines)
 
@@ -88,6 +165,17 @@ class Coins(CoinsBase):
     def _handle_help(self, message, params):
         return self.get_help()
 
+    def _handle_history(self, message, params):
+        user = message['metadata']['source_user']
+        after = None
+        if params:
+            try:
+                after = int(params[0])
+            except ValueError:
+                return f'{params[0]} is not a valid transaction ID.'
+
+        return self._format_history(user, after)
+
     def _handle_pay(self, message, params):
         payer = message['metadata']['source_user']
         if len(params) < 2:
@@ -106,6 +194,47 @@ class Coins(CoinsBase):
         return self._handle_pay(message, params)
 
     # Format Methods
+    def _format_history(self, user, after=None):
+        """A page of a user's transactions, older than `after` if given"""
+        # Keyset pages of the sent and received sides each walk an index
+        # in id order, so a page costs the same however deep it is.
+        sides = [
+            self.db.transaction.query(
+                _filter={field: user},
+                sort='id,desc',
+                limit=HISTORY_PAGE_SIZE + 1,
+                after=after,
+                compact=True
+            )
+            for field in ['payer_id', 'payee_id']
+        ]
+        txs = list(islice(
+            merge(*sides, key=lambda tx: -tx.id), HISTORY_PAGE_SIZE + 1))
+
+        if not txs:
+            return 'No more transactions.' if after else 'No transactions.'
+
+        lines = [f'Transactions for <@{user}>:']
+        for tx in txs[:HISTORY_PAGE_SIZE]:
+            day = datetime.utcfromtimestamp(
+                tx.tx_timestamp).strftime('%Y-%m-%d')
+            if tx.payer_id == user:
+                action = f'sent {tx.amount} {self.name} to'
+                other = tx.payee_id
+            else:
+                action = f'received {tx.amount} {self.name} from'
+                other = tx.payer_id
+
+            other = f'<@{other}>' if USER_ID.match(other) else other
+            memo = f' ({tx.memo})' if tx.memo else ''
+            lines.append(f'• `{tx.id}` {day}: {action} {other}{memo}')
+
+        if len(txs) > HISTORY_PAGE_SIZE:
+            last = txs[HISTORY_PAGE_SIZE - 1].id
+            lines.append(f'More: `{self.triggers[0]} history {last}`')
+
+        return '\n'.join(lines)
+
     def _format_pay(self, payer, payee, amount, memo=None):
         if not payee.startswith('@') and not payee.startswith('<@'):
             return f'{payee} is not a valid tip recipient.'
@@ -139,6 +268,13 @@ class CoinsSecretWord(CoinsBase):
         super().__init__(baseplate, lock, **kwargs)
 
         utils.set_properties(self, kwargs.get('properties', []), __file__)
+        self.common_words = frozenset(
+            w.lower() for w in getattr(self, 'common_words', []))
+        # Candidate words from live traffic, by secret_word period (ID) and
+        # user. Only periods that started after this are fully covered.
+        self.candidates = {}
+        self.candidates_lock = threading.Lock()
+        self.candidates_since = utils.now()
         self._set_secret_word()
 
     # Std Methods
@@ -166,9 +302,9 @@ class CoinsSecretWord(CoinsBase):
             self._admin_reset_secret_word(message)
             return False
 
-        match = re.search(f'\\W*{self.secret_word}\\W*', text.lower())
+        self._collect_candidates(message)
 
-        return match
+        return self.matcher.match(text)
 
     def handle(self, message):
         _args = [self.secret_word, message]
@@ -232,25 +368,66 @@ class CoinsSecretWord(CoinsBase):
             blocks=json.dumps(blocks)
         )
 
-    def _generate_secret_word(self, periods=None):
-        if not periods or periods < 1:
-            periods = 1
-
-        fillups = self.db.secret_word.query(limit=periods, sort='id,desc')
-
-        if periods == 1:
-            fillups = (fillups['ts'], utils.now())
-        else:
-            fillups = (fillups[periods - 1]['ts'], utils.now())
-
-        users = self.db.balance.query(
-            limit=10,
-            sort='balance,asc',
-            fields='user',
-            _filter={'user__op': {
-                'startswith': 'U', 'notin_': self.pool_excludes}}
-        )
-        users = utils.jsearch('[].user', users)
+    def _collect_candidates(self, message):
+        """Add the candidate words of a live message to the current period"""
+        user = utils.jsearch('metadata.source_user || ""', message)
+        # Legobot rewrites mentions in `text` to display names, the raw text
+        # keeps them as <@U...> so they're dropped like in the history
+        text = utils.jsearch('metadata.text || ""', message)
+        if (
+            not user.startswith('U')
+            or not isinstance(text, str)
+            or CANDIDATE_SKIP.search(text)
+        ):
+            return
+
+        words = self._extract_candidates(text)
+        if words:
+            with self.candidates_lock:
+                period = self.candidates.setdefault(self.secret_id, {})
+                pool = period.setdefault(user, [])
+                pool += words[:MAX_USER_CANDIDATES - len(pool)]
+
+    def _extract_candidates(self, text):
+        words = []
+        for emoji, word in CANDIDATE_TOKENS.findall(text):
+            if emoji:
+                words.append(emoji)
+            elif word:
+                word = word.lower()
+                if word not in self.common_words:
+                    words.append(word)
+
+        return words
+
+    def _start_candidate_period(self, _id):
+        self.secret_id = _id
+        with self.candidates_lock:
+            self.candidates.setdefault(_id, {})
+            for old in sorted(self.candidates)[:-MAX_WORD_PERIODS]:
+                del self.candidates[old]
+
+    def _get_word_pool(self, users, records):
+        """Get {user: [candidate words]} for the periods of records.
+
+        Served from the live candidates when they cover every period, else
+        from the channel history (e.g. just after a restart).
+        """
+        if records[-1]['ts'] >= self.candidates_since:
+            word_pool = {}
+            with self.candidates_lock:
+                for record in records:
+                    period = self.candidates.get(record['id'], {})
+                    for user in users:
+                        if period.get(user):
+                            word_pool.setdefault(user, []).extend(
+                                period[user])
+
+            return word_pool
+
+        return self._get_history_word_pool(users, records[-1]['ts'])
+
+    def _get_history_word_pool(self, users, oldest):
         messages = []
 
         for channel in self.secret_word_channels:
@@ -261,37 +438,46 @@ class CoinsSecretWord(CoinsBase):
                 'messages',
                 total_limit=10000,
                 limit=1000,
-                latest=fillups[1],
-                oldest=fillups[0],
+                latest=utils.now(),
+                oldest=oldest,
                 channel=channel
             )
 
-        user_search = ('[?contains([{}], user) '
-                       '&& !contains(lower(text), `moin`) '
-                       '&& !starts_with(text, `!ak`)]').format(
-            ', '.join([f'`{u}`' for u in users])
-        )
-        messages = utils.jsearch(user_search, messages)
+        users = frozenset(users)
         word_pool = {}
 
         for message in messages:
-            user = message['user']
+            user = message.get('user')
+            text = message.get('text') or ''
+            if user not in users or CANDIDATE_SKIP.search(text):
+                continue
+
             if user not in word_pool:
                 word_pool[user] = []
 
-            word_pool[user] += re.findall(r':[a-zA-Z0-9_-]+:', message['text'])
-            string = re.sub(
-                r'(:[a-zA-Z0-9_-]+:)|(<@U[A-Z0-9]+>)', '', message['text'])
-            string = re.sub(r'\S+\.\S+', '', string)
-            words = re.findall(r'\b\w+\b', string)
-            word_pool[user] += [
-                w.lower() for w in words
-                if len(w) > 3
-                and w.lower() not in self.common_words
-            ]
+            word_pool[user] += self._extract_candidates(text)
+
+        return word_pool
+
+    def _generate_secret_word(self, periods=None):
+        if not periods or periods < 1:
+            periods = 1
+
+        records = self.db.secret_word.latest(periods)
+        records = [records] if periods == 1 else records
+
+        users = self.db.balance.query(
+            limit=10,
+            sort='balance,asc',
+            fields='user',
+            _filter={'user__op': {
+                'startswith': 'U', 'notin_': self.pool_excludes}}
+        )
+        users = utils.jsearch('[].user', users)
+        word_pool = self._get_word_pool(users, records)
 
         users = [k for k in word_pool.keys() if word_pool[k]]
-        last_ten = self.db.secret_word.query(sort='id,desc', limit=10)
+        last_ten = self.db.secret_word.latest(10)
         last_ten = utils.jsearch('[].secret_word', last_ten)
         if len(users) > 2 or periods >= 10:
             word = last_ten[0]
@@ -313,7 +499,7 @@ class CoinsSecretWord(CoinsBase):
         return word, user
 
     def _payout(self, word, message):
-        records = self.db.secret_word.query(limit=2, sort='id, DESC')
+        records = self.db.secret_word.latest(2)
         time_diff = records[0]['ts'] - records[1]['ts']
 
         if time_diff > 999:
@@ -321,36 +507,29 @@ class CoinsSecretWord(CoinsBase):
 
         percent = randint(45, 80) / 100
         amt = int(time_diff * percent)
-        pool = self._get_balance('secret_word_pool', True)
+        self._get_balance('secret_word_pool', True)
 
-        if self._update_balance('secret_word_pool', pool + amt):
-            if self._write_tx(
-                'None',
+        if self._deposit('secret_word_pool', amt, 'secret_word deposit'):
+            self._pay(
                 'secret_word_pool',
+                utils.jsearch('metadata.source_user || ""', message),
                 amt,
-                'secret_word deposit',
-                utils.now()
-            ):
-                self._pay(
-                    'secret_word_pool',
-                    utils.jsearch('metadata.source_user || ""', message),
-                    amt,
-                    f'You said the secret word! {word}.'
-                )
+                f'You said the secret word! {word}.'
+            )
 
-                return amt
+            return amt
 
         return 0
 
     def _set_completed(self, word):
-        record = self.db.secret_word.query(limit=1, sort='id, DESC')
+        record = self.db.secret_word.latest()
 
         if record and record['secret_word'] == word:
             record['completed'] = True
             self.db.secret_word.upsert(record)
 
     def _set_secret_word(self, skip_current=False):
-        record = self.db.secret_word.query(limit=1, sort='id, DESC')
+        record = self.db.secret_word.latest()
 
         if (
             record
@@ -359,6 +538,8 @@ class CoinsSecretWord(CoinsBase):
         ):
             self.secret_word = record['secret_word']
             self.secret_ts = record['ts']
+            self.matcher = SecretWordMatcher(self.secret_word)
+            self._start_candidate_period(record['id'])
         else:
             LOGGER.info('Setting new secret word.')
             word, user = self._generate_secret_word()
@@ -370,6 +551,9 @@ class CoinsSecretWord(CoinsBase):
             })
             self.secret_word = word
             self.secret_ts = now
+            self.matcher = SecretWordMatcher(word)
+            self._start_candidate_period(
+                self.db.secret_word.latest(return_field_value='id'))
 
 
 class CoinsPoolManager(CoinsBase):
@@ -378,9 +562,26 @@ class CoinsPoolManager(CoinsBase):
 
         utils.set_properties(self, kwargs.get('properties', []), __file__)
         self.paid = []
+        # (fillup_ts, amount) of deposits made per pool_id being closed
+        self.deposits = {}
         self._init_escrow()
         self.next_pool = self._get_next_pool()
-        self._update_pool()
+        self.pool_id = self._get_pool_id()
+        # Message counts per (pool_id, user) not yet added to the participant
+        # table, flushed every PARTICIPANT_FLUSH seconds and before payouts
+        self.participants = Counter()
+        self.participants_lock = threading.Lock()
+        self.bot_users = {}
+        # Fill-ups run on the shared scheduler thread, not the message path.
+        # An overdue fill-up (e.g. after downtime) runs right away.
+        self.stopping = False
+        self.jobs_lock = threading.Lock()
+        self.pool_job = None
+        self.flush_job = None
+        self.scheduler = get_scheduler()
+        self._schedule_job('pool_job', self.next_pool, self._run_pool_job)
+        self._schedule_job(
+            'flush_job', utils.now() + PARTICIPANT_FLUSH, self._run_flush_job)
 
     # Init Methods
     def _init_escrow(self):
@@ -389,18 +590,21 @@ class CoinsPoolManager(CoinsBase):
             self._update_balance('escrow', 0)
 
     # Std Methods
+    def on_stop(self):
+        with self.jobs_lock:
+            self.stopping = True
+            for job in (self.pool_job, self.flush_job):
+                if job:
+                    self.scheduler.cancel(job)
+
+        self._flush_participants()
+
     def listening_for(self, message):
         if utils.is_delete_event(message):
             return False
 
+        self._track_participant(message)
         text = message.get('text') if message.get('text') else ''
-
-        if (
-            utils.now() > getattr(self, 'next_pool', 0)
-            and 'moin' not in text.lower()
-        ):
-            self._update_pool()
-
         _handle = False
         if isinstance(text, str):
             params = re.split(r'\s+', text.lower())
@@ -458,8 +662,8 @@ class CoinsPoolManager(CoinsBase):
             )
 
     def _get_next_pool(self):
-        next_pool = self.db.pool_history.query(
-            limit=1, sort='id,desc', return_field_value='next_fillup_ts')
+        next_pool = self.db.pool_history.latest(
+            return_field_value='next_fillup_ts')
 
         return next_pool if next_pool else 0
 
@@ -481,41 +685,133 @@ class CoinsPoolManager(CoinsBase):
 
         return ', '.join(out)
 
-    def _get_participants(self, oldest):
+    def _get_pool_id(self):
+        return self.db.pool_history.latest(return_field_value='id') or 0
+
+    def _track_participant(self, message):
+        metadata = message.get('metadata', {})
+        user = metadata.get('source_user')
+
+        if (
+            isinstance(user, str)
+            and user.startswith('U')
+            and metadata.get('source_channel') in self.participant_channels
+            and metadata.get('subtype') not in NON_PARTICIPANT_SUBTYPES
+            and not self._is_bot(user)
+        ):
+            with self.participants_lock:
+                self.participants[(self.pool_id, user)] += 1
+
+    def _flush_participants(self):
+        with self.participants_lock:
+            pending, self.participants = self.participants, Counter()
+
+        if not pending:
+            return
+
+        records = [
+            {'pool_id': pool_id, 'user': user, 'messages': n}
+            for (pool_id, user), n in pending.items()
+        ]
+        if not self.db.participant.add_counts(records, 'messages'):
+            with self.participants_lock:
+                self.participants.update(pending)
+
+    def _is_bot(self, user):
+        # Bots posting as_user have a U... ID and no bot_message subtype.
+        # The connector keeps users.list (with is_bot) and refreshes it for
+        # unknown IDs, the result is kept per user.
+        if user not in self.bot_users:
+            info = {}
+            if self.botThread:
+                self.botThread.get_user_name_by_id(user)
+                info = self.botThread.users_by_id.get(user) or {}
+
+            self.bot_users[user] = info.get('is_bot') is True
+
+        return self.bot_users[user]
+
+    def _schedule_job(self, name, due, func):
+        # Under jobs_lock so a job that runs (and reschedules itself) right
+        # away can't be overwritten by the assignment of its own scheduling,
+        # and on_stop always cancels the latest one.
+        with self.jobs_lock:
+            if not self.stopping:
+                setattr(self, name, self.scheduler.schedule(due, func))
+
+    def _run_flush_job(self):
+        if self.stopping:
+            return
+
+        try:
+            self._flush_participants()
+        finally:
+            self._schedule_job(
+                'flush_job', utils.now() + PARTICIPANT_FLUSH,
+                self._run_flush_job)
+
+    def _get_participants(self, pool_id, oldest):
+        """Get {user: message count} for a pool period.
+
+        Read from the participant table, or from the channel history if the
+        period wasn't tracked (e.g. it started before tracking was added).
+        """
+        excludes = frozenset(self.pool_excludes + ['USSLACKBOT'])
+        self._flush_participants()
+        participants = dict(self.db.participant.iter_query(
+            fields=['user', 'messages'],
+            _filter={'pool_id': pool_id},
+            compact=True
+        ))
+
+        if not participants:
+            participants = Counter(self._get_history_participants(oldest))
+
+        return {
+            user: n for user, n in participants.items()
+            if user not in excludes and not self._is_bot(user)
+        }
+
+    def _get_history_participants(self, oldest):
         participants = []
         for channel in self.participant_channels:
             participants += utils.call_slack_api(
                 self.botThread.slack_client,
                 'conversations.history',
                 True,
-                'messages[?!contains(keys(@), `"bot_id"`)].user',
+                ('messages[?!contains(keys(@), `"bot_id"`) '
+                 '&& subtype != `"bot_message"`].user'),
                 channel=channel,
                 oldest=f'{oldest}.000000'
             )
 
-        return [
-            p for p in participants
-            if p not in self.pool_excludes + ['USSLACKBOT']
-        ]
+        return participants
 
-    def _pay_participants(self):
-        oldest = self.db.pool_history.query(
-            sort={'field': 'id', 'direction': 'DESC'},
-            limit=1,
-            return_field_value='fillup_ts'
-        )
-        self.paid.append(oldest)
-        participants = self._get_participants(oldest)
+    @staticmethod
+    def _draw_participants(participants):
+        """Yield users at random, weighted by message count, without replacement
+
+        Users are ordered by exponential keys with rate = message count
+        (heapify is linear, each draw is log n).
+        """
+        draw = [(expovariate(n), user) for user, n in participants.items()]
+        heapify(draw)
+
+        while draw:
+            yield heappop(draw)[1]
+
+    def _pay_participants(self, pool_id):
+        oldest = self.db.pool_history.latest(return_field_value='fillup_ts')
+        self.paid.append(pool_id)
+        participants = self._get_participants(pool_id, oldest)
         payees = {}
         balance = self._get_balance('pool')
         multipliers = [23, 29, 31, 37, 41, 43, 47, 53]
 
-        while True:
-            if balance < 159 or not participants:
+        for user in self._draw_participants(participants):
+            if balance < 159:
                 break
 
-            user = choice(participants)
-            participants = [p for p in participants if p != user]
             amount = choice((1, 2, 3)) * choice(multipliers)
             payees[user] = amount
             if self._pay('pool', user, amount, 'Participation Trophies!'):
@@ -523,32 +819,63 @@ class CoinsPoolManager(CoinsBase):
 
         self._announce_payments(payees)
 
-    def _update_pool(self):
-        _now = utils.now()
-        if self.next_pool <= _now:
-            if self.next_pool not in self.paid:
-                self._pay_participants()
+    def _run_pool_job(self):
+        if self.stopping:
+            return
+
+        try:
+            self._update_pool()
+        finally:
+            # Retry a failed fill-up after POOL_RETRY seconds
+            self._schedule_job(
+                'pool_job', max(self.next_pool, utils.now() + POOL_RETRY),
+                self._run_pool_job)
 
-            today = datetime.fromtimestamp(_now, timezone('US/Eastern'))
-            tomorrow = today + timedelta(days=1)
+    @staticmethod
+    def _get_next_fillup(ts):
+        """Get 08:30 Eastern on the day after ts, skipping Sundays"""
+        day = datetime.fromtimestamp(ts, POOL_TZ).date() + timedelta(days=1)
 
-            if tomorrow.weekday() == 6:
-                tomorrow = tomorrow + timedelta(days=1)
+        if day.weekday() == 6:
+            day = day + timedelta(days=1)
 
-            tomorrow = re.sub(
-                r'\d\d:\d\d:\d\d', '08:30:00', tomorrow.isoformat())
-            self.next_pool = int(datetime.fromisoformat(tomorrow).timestamp())
-            amt = randint(25, 75) * 10
-            pool_balance = self._get_balance('pool', True)
+        fillup = POOL_TZ.localize(datetime(
+            day.year, day.month, day.day, *POOL_FILLUP_TIME))
 
-            if self._update_balance('pool', pool_balance + amt):
-                if self._write_tx(
-                        'None', 'pool', amt, 'daily pool deposit', _now):
-                    self.db.pool_history.upsert({
-                        'fillup_ts': _now,
-                        'next_fillup_ts': self.next_pool,
-                        'amount': amt
-                    })
+        return int(fillup.timestamp())
+
+    def _update_pool(self):
+        _now = utils.now()
+        if self.next_pool <= _now:
+            pool_id = self._get_pool_id()
+            if pool_id not in self.paid:
+                # Count messages toward the next pool (the pool_history row
+                # written below) before the final flush of the paid one
+                with self.participants_lock:
+                    self.pool_id = pool_id + 1
+
+                self._pay_participants(pool_id)
+
+            # next_pool only moves once the deposit and its pool_history row
+            # are written, until then the pool job retries the fill-up. A
+            # retry after a failed history write doesn't deposit again.
+            if pool_id not in self.deposits:
+                amt = randint(25, 75) * 10
+                self._get_balance('pool', True)
+                if not self._deposit('pool', amt, 'daily pool deposit', _now):
+                    return
+
+                self.deposits[pool_id] = (_now, amt)
+
+            fillup_ts, amt = self.deposits[pool_id]
+            next_pool = self._get_next_fillup(fillup_ts)
+            if self.db.pool_history.upsert({
+                'id': pool_id + 1,
+                'fillup_ts': fillup_ts,
+                'next_fillup_ts': next_pool,
+                'amount': amt
+            }):
+                self.next_pool = next_pool
 
 
 class CoinsAdmin(CoinsBase):
@@ -596,39 +923,73 @@ class CoinsAdmin(CoinsBase):
     def _handle_balances(self, message, params):
         return self._format_get_balances()
 
+    def _handle_cache(self, message, params):
+        if self._is_private_message(message):
+            if params and params[0] == 'reset':
+                self.balance_cache.invalidate()
+                return 'Balance cache reset.'
+
+            stats = self.balance_cache.stats()
+            return ('Balance cache: {hits} hits, {misses} misses, '
+                    '{users} users cached.').format(**stats)
+
+    def _handle_writes(self, message, params):
+        if self._is_private_message(message):
+            lines = ['The ledger write queue is disabled.']
+            if self.db.writer:
+                lines = [(
+                    'Ledger writes: {depth} queued, {operations} written in '
+                    '{commits} commits (avg batch {avg_batch:.1f}, max '
+                    '{max_batch}), avg commit {avg_commit_ms:.1f}ms (max '
+                    '{max_commit_ms:.1f}ms), {failures} failed.'
+                ).format(**self.db.writer.metrics())]
+
+            if self.optimistic_balances is True:
+                lines.append((
+                    'Optimistic balance writes: {writes} attempts, '
+                    '{conflicts} conflicts, {exhausted} out of retries.'
+                ).format(**self.conflict_stats.stats()))
+
+            return '\n'.join(lines)
+
     def _handle_dedupe(self, message, params):
         """Remove duplicate moin escrow payouts"""
-        if params:
+        since = None
+        incremental = not params or params[0] == 'all'
+
+        if not incremental:
             # Dedupe a specific user
             users = [re.sub(r'[@<>]', '', params[0])]
         else:
-            # Dedupe all users
-            reg = re.compile(r'^U[A-Z0-9]{8,10}$')
-            users = self.db.balance.query(fields=['user'])
-            users = [u['user'] for u in users if reg.match(u['user'])]
+            # Dedupe all users. Only look at payouts after the watermark of
+            # the last run (plus some overlap) unless a full run is requested
+            users = [
+                u.user
+                for u in self.db.balance.iter_query(
+                    fields=['user'], compact=True)
+                if USER_ID.match(u.user)
+            ]
+            since = self._get_dedupe_since() if not params else None
 
-        all_dupes = []
+        payouts = self._get_escrow_payouts(users, since)
+        dupes = self._get_duplicate_escrow_payouts(payouts)
+        response = self._format_dedupe(self._check_dupes_against_escrow(dupes))
 
-        for user in users:
-            dupes = self._get_duplicate_escrow_payouts(user)
-            if dupes:
-                all_dupes += self._check_dupes_against_escrow(user, dupes)
+        if incremental:
+            self._set_dedupe_watermark(payouts)
 
-        return self._format_dedupe(all_dupes)
+        return response
 
     def _handle_escrow(self, message, params):
         if self._is_private_message(message):
-            current_escrow_id = self.db.pool_history.query(
-                sort={'field': 'id', 'direction': 'desc'},
-                limit=1,
-                return_field_value='id'
-            )
+            current_escrow_id = self.db.pool_history.latest(
+                return_field_value='id')
             if current_escrow_id:
                 return self._format_get_escrow(current_escrow_id)
 
     def _handle_get_secret_word(self, message, params):
         if self._is_private_message(message):
-            record = self.db.secret_word.query(limit=1, sort='id, DESC')
+            record = self.db.secret_word.latest()
 
             if not record:
                 return 'Error getting secret word from db.'
@@ -639,6 +1000,10 @@ class CoinsAdmin(CoinsBase):
             return (f'The latest secret word is `{word}` and '
                     f'{completed} been guessed')
 
+    def _handle_report(self, message, params):
+        if self._is_private_message(message):
+            return self._format_report(params[0] if params else None)
+
     def _handle_user_balance(self, message, params):
         if self._is_private_message(message) and params:
             user = params[0]
@@ -652,86 +1017,180 @@ class CoinsAdmin(CoinsBase):
             payee = params[1]
             payee = payee[2:-1] if payee.startswith('<@') else payee
 
+            # Admin transfers are used to correct balances, so re-read both
+            # accounts from the DB instead of trusting the cache.
+            self.balance_cache.invalidate(payer, payee)
+
+            amt = None
             if len(params) > 2:
                 amt = params[2]
                 try:
                     amt = int(amt)
                 except Exception:
                     return f'{amt} is an invalid amount.'
-            else:
-                amt = self._get_balance(payer)
 
-        if self._pay(payer, payee, amt, 'Admin transfer'):
-            return 'Transfered {} {} from {} to {} successfully'.format(
-                amt, self.name, params[0], params[1])
+            # Hold both accounts so a full transfer moves the balance as read
+            with account_locks(payer, payee):
+                if amt is None:
+                    amt = self._get_balance(payer)
+
+                paid = self._pay(payer, payee, amt, 'Admin transfer')
+
+            if paid is True:
+                return 'Transfered {} {} from {} to {} successfully'.format(
+                    amt, self.name, params[0], params[1])
 
     # Action Methods
-    def _check_dupes_against_escrow(self, user, dupes):
+    def _check_dupes_against_escrow(self, dupes):
         """Check potential duplicates against actual escrow"""
-        out = []
+        if not dupes:
+            return []
+
+        get_group = self._get_pool_group_lookup()
+        candidates = []
+
         for (first, second) in dupes:
             # Get the escrow group IDs for the provided duplicate pairs
             # based on payout timestamp, plus the group ID previous
-            grps = [self.db.pool_history.query(
-                _filter={'fillup_ts__op': {'__ge__': first['tx_timestamp']}},
-                limit=1,
-                return_field_value='id'
-            ) - 1]
-            grps.append(grps[-1] - 1)
-            grps.append(self.db.pool_history.query(
-                _filter={'fillup_ts__op': {'__ge__': second['tx_timestamp']}},
-                limit=1,
-                return_field_value='id'
-            ) - 1)
-            grps.append(grps[-1] - 1)
-
-            # Query the escrow table for these group IDs, user, and amount.
-            # If only one result is found these are genuine dupes.
-            found = self.db.escrow.query(
-                _filter={
-                    'escrow_group_id': {'in_': [str(g) for g in grps]},
-                    'payee_id': user,
-                    'amount': first['amount']
-                }
+            grps = []
+            for tx in (first, second):
+                grp = get_group(tx['tx_timestamp'])
+                if grp is None:
+                    break
+
+                grps += [str(grp), str(grp - 1)]
+
+            if len(grps) == 4:
+                candidates.append((first, second, set(grps)))
+            else:
+                LOGGER.warning(f'No pool period found for {first}, {second}')
+
+        # Count the escrow records of all candidate users in one pass,
+        # keyed by group ID, user, and amount.
+        users = list(set(first['payee_id'] for first, _, _ in candidates))
+        escrow = Counter(self.db.escrow.iter_query(
+            fields=['escrow_group_id', 'payee_id', 'amount'],
+            _filter={'payee_id': {'in_': users}},
+            compact=True
+        )) if users else Counter()
+        out = []
+
+        for (first, second, grps) in candidates:
+            # If only one escrow record is found these are genuine dupes.
+            found = sum(
+                escrow[(grp, first['payee_id'], first['amount'])]
+                for grp in grps
             )
-            if len(found) == 1:
+            if found == 1:
                 out.append((first, second))
             else:
-                print(f'Not duplicate beause {found}')
+                LOGGER.info(
+                    f'Not duplicate because {found} escrow records found '
+                    f'for {first}, {second}'
+                )
 
         return out
 
-    def _get_duplicate_escrow_payouts(self, user):
-        """Get all potential duplicate moin payouts for a user"""
+    def _get_dedupe_since(self):
+        watermark = self.db.watermark.get(
+            'dedupe', return_field_value='tx_timestamp')
+        if watermark is None:
+            return None
 
-        # Get all transactions for moin payouts from escrow to user
-        payouts = self.db.transaction.query(
-            _filter={
-                'payer_id': 'escrow',
-                'payee_id': user,
-                'memo': 'Happy Moin!'
-            },
+        return watermark - getattr(self, 'dedupe_overlap', DEDUPE_OVERLAP)
+
+    def _get_duplicate_escrow_payouts(self, payouts):
+        """Get all potential duplicate moin payouts from users' payouts"""
+        dupes = []
+
+        for user, txs in payouts.items():
+            dupes += self._pair_payouts(deque(txs))
+
+        return dupes
+
+    def _get_escrow_payouts(self, users, since=None):
+        """Get moin payouts from escrow to users, grouped by user"""
+        _filter = {'payer_id': 'escrow', 'memo': 'Happy Moin!'}
+        if len(users) == 1:
+            _filter['payee_id'] = users[0]
+
+        if since is not None:
+            _filter['tx_timestamp__op'] = {'__ge__': since}
+
+        # Get all the payouts in a single scan
+        payouts = {user: [] for user in users}
+        for tx in self.db.transaction.iter_query(
+            _filter=_filter,
             sort={'field': 'tx_timestamp'}
-        )
+        ):
+            if tx['payee_id'] in payouts:
+                payouts[tx['payee_id']].append(tx)
+
+        for txs in payouts.values():
+            txs.sort(key=lambda tx: (tx['tx_timestamp'], tx['id']))
+
+        return payouts
+
+    def _get_pool_group_lookup(self):
+        """Get a function that returns the escrow group ID for a timestamp
+
+        That is the ID before the first pool_history record (in ID order)
+        filled up at or after the timestamp, found with a binary search over
+        the running max of fillup_ts.
+        """
+        ids = []
+        fillups = []
+
+        for _id, fillup in self.db.pool_history.iter_query(
+            fields=['id', 'fillup_ts'],
+            sort='id,asc',
+            compact=True
+        ):
+            ids.append(_id)
+            fillups.append(max(fillup, fillups[-1]) if fillups else fillup)
+
+        def get_group(ts):
+            i = bisect_left(fillups, ts)
+            return ids[i] - 1 if i < len(ids) else None
+
+        return get_group
+
+    def _pair_payouts(self, payouts):
+        """Pair up a user's payouts that are potential duplicates"""
         dupes = []
 
         # Loop through list. If one of the two following tx is the same amount,
         # it is a potential duplicate
         while payouts:
-            tx = payouts.pop(0)
+            tx = payouts.popleft()
             amt = tx['amount']
 
             if len(payouts) >= 2 and payouts[1]['amount'] == amt:
-                dupes.append([tx, payouts.pop(1)])
+                dupes.append([tx, payouts[1]])
+                del payouts[1]
 
             if payouts and payouts[0]['amount'] == amt:
-                dupes.append([tx, payouts.pop(0)])
+                dupes.append([tx, payouts.popleft()])
 
         return dupes
 
+    def _set_dedupe_watermark(self, payouts):
+        """Record the last payout examined by an all users dedupe"""
+        last = [txs[-1] for txs in payouts.values() if txs]
+        if not last:
+            return
+
+        last = max(last, key=lambda tx: (tx['tx_timestamp'], tx['id']))
+        self.db.watermark.upsert({
+            'id': 'dedupe',
+            'tx_id': last['id'],
+            'tx_timestamp': last['tx_timestamp']
+        })
+
     # Formatter Methods
     def _format_dedupe(self, dupes):
         out = ['The following duplicate transactions were corrected:']
+        corrected = []
 
         for dupe in dupes:
             user = dupe[1]['payee_id']
@@ -746,7 +1205,10 @@ class CoinsAdmin(CoinsBase):
             # Update the tx log to mark one as a duplicate.
             # Also prevents subsequent dedupe runs from flagging this tx again.
             dupe[1]['memo'] += ' DUPLICATE. CORRECTED.'
-            self.db.transaction.upsert(dupe[1])
+            corrected.append(dupe[1])
+
+        if corrected:
+            self.db.transaction.bulk_upsert(corrected)
 
         # If the out array only contains the heading, there are no dupes
         if len(out) == 1:
@@ -769,6 +1231,33 @@ class CoinsAdmin(CoinsBase):
 
         return response
 
+    def _format_report(self, name):
+        report = REPORTS.get(name)
+        if not report:
+            return 'Available reports: {}'.format(', '.join(REPORTS.keys()))
+
+        rows = self.db.transaction.aggregate(**report['query'])
+        if rows is None:
+            return 'There was an error processing this request. See logs.'
+
+        if not rows:
+            return f'No data for report {name}.'
+
+        for row in rows:
+            if 'day' in row:
+                row['day'] = datetime.utcfromtimestamp(
+                    row['day']).strftime('%Y-%m-%d')
+
+        table = text.tabulate_data(
+            rows,
+            report['headers'],
+            fields=list(report['headers'].keys()),
+            user_id_field=report.get('user_id_field'),
+            thread=self.botThread
+        )
+
+        return f'{report["title"]}: {table}'
+
     def _format_get_escrow(self, escrow_group_id):
         response = None
         escrow = self.db.escrow.query(
@@ -1,22 +1,211 @@
+from collections import Counter
+from contextlib import contextmanager
+from contextlib import nullcontext
 from copy import copy
 import logging
 import os
+import re
+import threading
+import zlib
 
 from Legobot.Connectors.Slack import Slack
 from Legobot.Lego import Lego
 
 from helpers import file
-from helpers.sql import DB
+from helpers.sql import get_db
 from helpers import utils
 
 LOCAL_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..')
 LOGGER = logging.getLogger(__name__)
+DB_ENGINE = {
+    'pragmas': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -16000,
+        'mmap_size': 67108864,
+        'busy_timeout': 5000
+    },
+    'write_queue': {
+        'max_size': 1000,
+        'max_batch': 100
+    }
+}
 DEFAULTS = {
     'name': 'Coins',
     'starting_value': 20,
-    'triggers': ['!coins']
+    'triggers': ['!coins'],
+    'db_engine': DB_ENGINE,
+    'optimistic_balances': False,
+    'balance_retries': 5
 }
 
+BALANCE_CACHES = {}
+BALANCE_CACHES_LOCK = threading.Lock()
+CONFLICT_STATS = {}
+
+SECRET_WORD_TOKENS = re.compile(r':[a-z0-9_-]+:|\w+')
+
+ACCOUNT_LOCK_STRIPES = 64
+ACCOUNT_LOCKS = [threading.RLock() for _ in range(ACCOUNT_LOCK_STRIPES)]
+
+
+def account_stripe(user):
+    return zlib.crc32(str(user).encode()) % ACCOUNT_LOCK_STRIPES
+
+
+@contextmanager
+def account_locks(*users):
+    """Hold the lock stripes of the given users while mutating balances.
+
+    Stripes are always taken in ascending order so callers locking
+    overlapping users can't deadlock. Locks are reentrant, but a nested
+    call must only lock users already held.
+    """
+    locks = [
+        ACCOUNT_LOCKS[stripe]
+        for stripe in sorted(set(account_stripe(u) for u in users))
+    ]
+    for lock in locks:
+        lock.acquire()
+
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+class BalanceCache(object):
+    """Write-through in-memory copy of the balance table.
+
+    One instance is shared by every lego using the same DB (see
+    get_balance_cache). The table is loaded on first read, writers set the
+    balances they committed (absolute values, never deltas, so a load that
+    already saw the commit can't count it twice), and invalidated users are
+    re-read from the DB on their next lookup.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.lock = threading.Lock()
+        self.balances = {}
+        self.loaded = False
+        self.stale = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        self.balances = dict(
+            self.table.iter_query(fields=['user', 'balance'], compact=True))
+        self.stale = set()
+        self.loaded = True
+
+    def get(self, user):
+        with self.lock:
+            if not self.loaded:
+                self.misses += 1
+                self._load()
+            elif user in self.stale:
+                self.misses += 1
+                self.stale.discard(user)
+                balance = self.table.get(user, return_field_value='balance')
+                if balance is None:
+                    self.balances.pop(user, None)
+                else:
+                    self.balances[user] = balance
+
+            else:
+                self.hits += 1
+
+            return self.balances.get(user)
+
+    def set(self, user, balance):
+        with self.lock:
+            if self.loaded:
+                self.balances[user] = balance
+                self.stale.discard(user)
+
+    def invalidate(self, *users):
+        """Invalidate the given users, or the whole cache if none given"""
+        with self.lock:
+            if users:
+                self.stale.update(users)
+            else:
+                self.balances = {}
+                self.stale = set()
+                self.loaded = False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'users': len(self.balances)
+            }
+
+
+def get_balance_cache(db):
+    with BALANCE_CACHES_LOCK:
+        if db not in BALANCE_CACHES:
+            BALANCE_CACHES[db] = BalanceCache(db.balance)
+
+        return BALANCE_CACHES[db]
+
+
+class ConflictStats(object):
+    """Counters for optimistic balance writes on one DB."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def stats(self):
+        with self.lock:
+            return {
+                'writes': self.counts['writes'],
+                'conflicts': self.counts['conflicts'],
+                'exhausted': self.counts['exhausted']
+            }
+
+
+def get_conflict_stats(db):
+    with BALANCE_CACHES_LOCK:
+        if db not in CONFLICT_STATS:
+            CONFLICT_STATS[db] = ConflictStats()
+
+        return CONFLICT_STATS[db]
+
+
+class SecretWordMatcher(object):
+    """Match any of a set of secret words against message text.
+
+    Built once per set of words. Each message is lowercased and tokenized
+    once (emoji like `:tada:` are single tokens) and the words are checked
+    against the token set, so "secret" does not match "secretary". Words
+    that are not a single token are matched with one compiled pattern.
+    """
+    def __init__(self, *words):
+        self.words = [w.lower() for w in words if w]
+        self.tokens = frozenset(
+            w for w in self.words if SECRET_WORD_TOKENS.fullmatch(w))
+        phrases = [w for w in self.words if w not in self.tokens]
+        self.pattern = re.compile(r'(?<!\w)({})(?!\w)'.format(
+            '|'.join(map(re.escape, phrases)))) if phrases else None
+
+    def match(self, text):
+        """Return the first active word in text, else None"""
+        if not self.words or not isinstance(text, str):
+            return None
+
+        text = text.lower()
+        found = set(SECRET_WORD_TOKENS.findall(text)) & self.tokens
+        if self.pattern:
+            found.update(self.pattern.findall(text))
+
+        return next((w for w in self.words if w in found), None)
+
 
 class CoinsBase(Lego):
     def __init__(self, baseplate, lock, *args, **kwargs):
@@ -35,26 +224,11 @@ class CoinsBase(Lego):
                     for channel in getattr(self, prop)
                 ])
 
-        # set tx locations and load/initialize db
-        tables = {}
-        table_dir = os.path.join(LOCAL_DIR, 'data', 'tables')
-        for _file in os.listdir(table_dir):
-            path = os.path.join(table_dir, _file)
-            if os.path.isfile(path):
-                tables.update(file.load_file(path))
-
-        migrations = {}
-        migr_dir = os.path.join(LOCAL_DIR, 'data', 'table_migrations')
-        for _file in os.listdir(migr_dir):
-            path = os.path.join(migr_dir, _file)
-            if os.path.isfile(path):
-                migrations.update(file.load_file(path))
-
-        self._init_tx_db(tables, kwargs.get('seeds', {}), migrations)
+        self._init_tx_db(kwargs.get('seeds', {}), kwargs.get('tx_dir'))
 
     # Init Methods
-    def _init_tx_db(self, tables, seeds, migrations):
-        self.tx_dir = os.path.join(LOCAL_DIR, 'coins_tx')
+    def _init_tx_db(self, seeds, tx_dir=None):
+        self.tx_dir = tx_dir if tx_dir else os.path.join(LOCAL_DIR, 'coins_tx')
 
         if not os.path.isdir(self.tx_dir):
             os.mkdir(self.tx_dir)
@@ -64,9 +238,37 @@ class CoinsBase(Lego):
             if 'file' in info:
                 info['file'] = info['file'].replace('${tx_dir}', self.tx_dir)
 
-        self.db = DB('sqlite', self.tx_db_path, tables, seeds, migrations)
+        # All coin legos share one DB (engine, pool and tables) per path.
+        # The table and migration configs are only loaded by the first one.
+        self.db = get_db(
+            'sqlite',
+            self.tx_db_path,
+            lambda: self._load_db_config(seeds)
+        )
+        self.db.process_seeds(seeds)
+        self.balance_cache = get_balance_cache(self.db)
+        self.conflict_stats = get_conflict_stats(self.db)
+        if seeds:
+            self.balance_cache.invalidate()
+
         LOGGER.info(f'{self.name} DB successfully initialized.')
 
+    def _load_db_config(self, seeds):
+        config = {'seeds': seeds, 'engine': self.db_engine}
+
+        for key, _dir in [
+            ('tables', 'tables'),
+            ('migrations', 'table_migrations')
+        ]:
+            config[key] = {}
+            _dir = os.path.join(LOCAL_DIR, 'data', _dir)
+            for _file in os.listdir(_dir):
+                path = os.path.join(_dir, _file)
+                if os.path.isfile(path):
+                    config[key].update(file.load_file(path))
+
+        return config
+
     def _set_bot_thread(self):
         self.botThread = None
         children = self.baseplate._actor.children
@@ -88,12 +290,19 @@ class CoinsBase(Lego):
         if default is None:
             default = 0
 
-        balance = self.db.balance.get(user, return_field_value='balance')
+        balance = self.balance_cache.get(user)
 
         if not isinstance(balance, int) and write_starting_balance is True:
-            balance = self.starting_value
-            self._update_balance(user, balance)
-            self._write_tx('SYSTEM', user, balance, 'Starting Balance')
+            with self._account_locks(user):
+                balance = self.balance_cache.get(user)
+                if not isinstance(balance, int):
+                    if self._update_balance(user, self.starting_value):
+                        balance = self.starting_value
+                        self._write_tx(
+                            'SYSTEM', user, balance, 'Starting Balance')
+                    else:
+                        # Created by another writer in optimistic mode
+                        balance = self.balance_cache.get(user)
 
         if not isinstance(balance, int):
             balance = default
@@ -109,23 +318,95 @@ class CoinsBase(Lego):
 
         return user_id
 
+    def _deposit(self, payee, amount, memo, ts=None):
+        with self._account_locks(payee):
+            return self._transfer('None', payee, amount, memo, ts, mint=True)
+
     def _pay(self, payer, payee, amount, memo=None):
-        payer_balance = self._get_balance(payer)
-        if amount > payer_balance:
-            return 'NSF'
+        with self._account_locks(payer, payee):
+            return self._transfer(payer, payee, amount, memo)
+
+    def _transfer(self, payer, payee, amount, memo=None, ts=None, mint=False):
+        balances = self.db.transfer(
+            payer, payee, amount, memo, ts, mint=mint, return_balances=True)
+        if not isinstance(balances, dict):
+            return balances
+
+        if self.optimistic_balances is True:
+            # Without account locks sets could land out of commit order
+            self.balance_cache.invalidate(*balances)
+        else:
+            for user, balance in balances.items():
+                self.balance_cache.set(user, balance)
 
-        payee_balance = self._get_balance(payee)
-        payer_balance -= amount
-        payee_balance += amount
+        return True
 
-        debit = self._update_balance(payer, payer_balance)
-        credit = self._update_balance(payee, payee_balance)
-        tx = self._write_tx(payer, payee, amount, memo)
+    def _account_locks(self, *users):
+        # Ledger writes are atomic in the DB, the account locks keep the
+        # shared balance cache in step with them. Optimistic mode relies on
+        # versioned writes instead and invalidates the cache.
+        if self.optimistic_balances is True:
+            return nullcontext()
 
-        return all((debit, credit, tx))
+        return account_locks(*users)
 
     def _update_balance(self, user, amount):
-        return self.db.balance.upsert({'user': user, 'balance': amount})
+        """Set a user's balance.
+
+        amount can also be a function of the current balance (None for a
+        new user). In optimistic mode the write is a compare-and-set on the
+        balance version, retried up to balance_retries times on conflict,
+        and a constant amount only creates a missing balance: an existing
+        one (or one created concurrently) is left alone and gives False.
+        """
+        if self.optimistic_balances is True:
+            return self._update_balance_optimistic(user, amount)
+
+        with account_locks(user):
+            if callable(amount):
+                amount = amount(self.balance_cache.get(user))
+
+            ok = self.db.set_balance(user, amount) is True
+            if ok:
+                self.balance_cache.set(user, amount)
+            else:
+                self.balance_cache.invalidate(user)
+
+        return ok
+
+    def _update_balance_optimistic(self, user, amount):
+        ok = False
+
+        for _ in range(self.balance_retries + 1):
+            current = self.db.balance.get(user) or {}
+            value = amount
+            if callable(amount):
+                value = amount(current.get('balance'))
+            elif current:
+                break
+
+            result = self.db.set_balance(
+                user, value, current.get('version', 0))
+            self.conflict_stats.add('writes')
+
+            if result != 'CONFLICT':
+                ok = result is True
+                break
+
+            self.conflict_stats.add('conflicts')
+            if not callable(amount):
+                # Re-applying a constant would overwrite the other write
+                break
+        else:
+            self.conflict_stats.add('exhausted')
+            LOGGER.warning(
+                f'Gave up setting the balance of {user} after '
+                f'{self.balance_retries} retries.'
+            )
+
+        self.balance_cache.invalidate(user)
+
+        return ok
 
     def _write_tx(self, source, dest, amount, memo, ts=None):
         data = {
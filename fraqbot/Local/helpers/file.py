@@ -1,15 +1,21 @@
 
+from copy import deepcopy
 import csv
 import json
 import logging
 import os
 import re
+import threading
 
+from jsonschema.exceptions import best_match
 from jsonschema import validate
+from jsonschema.validators import validator_for
 import yaml
 
 
 LOGGER = logging.getLogger('helpers.file')
+SCHEMAS = {}
+SCHEMAS_LOCK = threading.Lock()
 
 
 def load_file(path, f_type=None, raw=None, delimiter=None, default=None,
@@ -47,6 +53,43 @@ def load_file(path, f_type=None, raw=None, delimiter=None, default=None,
     return data
 
 
+def iter_file(path, f_type=None, delimiter=None, chunk_size=1000):
+    """Yield the records of a data file in lists of up to chunk_size.
+
+    csv and jsonl files are read incrementally. json and yaml have to be
+    parsed whole: a list is still yielded in chunks, anything else is
+    yielded as is.
+    """
+    if not f_type:
+        f_type = path.rsplit('.', 1)[-1]
+
+    if f_type in ('csv', 'jsonl'):
+        with open(path, newline='' if f_type == 'csv' else None) as f:
+            if f_type == 'csv':
+                rows = csv.DictReader(f, delimiter=delimiter or ',')
+            else:
+                rows = (json.loads(line) for line in f if line.strip())
+
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+
+            if chunk:
+                yield chunk
+
+        return
+
+    data = load_file(path, f_type=f_type)
+    if isinstance(data, list):
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+    elif data is not None:
+        yield data
+
+
 def write_file(path, data, f_type=None):
     try:
         with open(path, 'w') as f:
@@ -63,11 +106,40 @@ def write_file(path, data, f_type=None):
         return None
 
 
-def load_schema(schema_file):
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _cached_schema(schema_file):
+    # Reloaded if the file or any file it references has changed since
+    path = os.path.realpath(schema_file)
+    with SCHEMAS_LOCK:
+        cached = SCHEMAS.get(path)
+
+    if cached is None or any(
+        _mtime(f) != mtime for f, mtime in cached['mtimes'].items()
+    ):
+        schema, files = _load_schema(path)
+        cached = {
+            'schema': schema,
+            'mtimes': {f: _mtime(f) for f in files},
+            'validator': None
+        }
+        with SCHEMAS_LOCK:
+            SCHEMAS[path] = cached
+
+    return cached
+
+
+def _load_schema(schema_file):
     schema = load_file(schema_file)
     raw_schema = yaml.safe_dump(schema)
     defs = {}
     files = {}
+    used = {schema_file}
     for match in re.finditer(r'\$file:\s(.*(.yaml|.json))', raw_schema):
         f_name = match.group(1)
         if f_name not in files:
@@ -86,7 +158,9 @@ def load_schema(schema_file):
                 f_name
             )
 
-        ref_schema = yaml.safe_dump(load_schema(path))
+        ref = _cached_schema(path)
+        used.update(ref['mtimes'].keys())
+        ref_schema = yaml.safe_dump(ref['schema'])
         ref_schema = ref_schema.replace('#/$defs', f'#/$defs/{prefix}')
         ref_schema = yaml.safe_load(ref_schema)
         defs[prefix] = ref_schema.pop('$defs', {})
@@ -101,7 +175,26 @@ def load_schema(schema_file):
 
         schema['$defs'].update(defs)
 
-    return schema
+    return schema, used
+
+
+def load_schema(schema_file):
+    """Load a schema file, inlining `$file` refs.
+
+    Results are cached by path and the mtimes of every file involved, and
+    each call returns a copy.
+    """
+    return deepcopy(_cached_schema(schema_file)['schema'])
+
+
+def _get_validator(schema_file):
+    cached = _cached_schema(schema_file)
+    if cached['validator'] is None:
+        cls = validator_for(cached['schema'])
+        cls.check_schema(cached['schema'])
+        cached['validator'] = cls(cached['schema'])
+
+    return cached['validator']
 
 
 def validate_schema(data, schema=None, schema_file=None, raise_ex=False):
@@ -113,9 +206,14 @@ def validate_schema(data, schema=None, schema_file=None, raise_ex=False):
     else:
         try:
             if schema_file:
-                schema = load_schema(schema_file)
+                # Reuse the compiled validator for the file
+                validator = _get_validator(schema_file)
+                error = best_match(validator.iter_errors(data))
+                if error is not None:
+                    raise error
+            else:
+                validate(data, schema)
 
-            validate(data, schema)
             out = True
         except Exception as e:
             errors.append(e)
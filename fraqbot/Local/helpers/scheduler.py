@@ -0,0 +1,97 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+SCHEDULER = None
+SCHEDULER_LOCK = threading.Lock()
+
+
+class Job(object):
+    def __init__(self, due, seq, func, args, kwargs):
+        self.due = due
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.due, self.seq) < (other.due, other.seq)
+
+
+class Scheduler(object):
+    """Run jobs at given unix timestamps on a single timer thread.
+
+    Jobs are kept in a heap ordered by due time. The thread sleeps until
+    the earliest one is due, or until a new job is scheduled. Jobs that
+    are already due (e.g. after downtime) run right away, in due order.
+    A failing job is logged and doesn't stop the others.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.logger = logging.getLogger('Scheduler')
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.stats = {'runs': 0, 'failures': 0}
+        self.thread = threading.Thread(
+            target=self._run, name='Scheduler', daemon=True)
+        self.thread.start()
+
+    def schedule(self, due, func, *args, **kwargs):
+        """Run func(*args, **kwargs) at due. Returns the Job."""
+        job = Job(due, next(self.counter), func, args, kwargs)
+        with self.condition:
+            heapq.heappush(self.heap, job)
+            self.condition.notify()
+
+        return job
+
+    def cancel(self, job):
+        with self.condition:
+            job.cancelled = True
+            self.condition.notify()
+
+    def pending(self):
+        with self.condition:
+            return sorted(j for j in self.heap if not j.cancelled)
+
+    def _next_job(self):
+        with self.condition:
+            while True:
+                while self.heap and self.heap[0].cancelled:
+                    heapq.heappop(self.heap)
+
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                delay = self.heap[0].due - self.clock()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                return heapq.heappop(self.heap)
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            try:
+                job.func(*job.args, **job.kwargs)
+                self.stats['runs'] += 1
+            except Exception:
+                self.stats['failures'] += 1
+                self.logger.exception(f'Scheduled job {job.func} failed')
+
+
+def get_scheduler():
+    """Get the process wide Scheduler, starting it on first use"""
+    global SCHEDULER
+
+    with SCHEDULER_LOCK:
+        if SCHEDULER is None:
+            SCHEDULER = Scheduler()
+
+        return SCHEDULER
@@ -1,19 +1,41 @@
+from collections import namedtuple
+from concurrent.futures import Future
 from copy import deepcopy
 from importlib import import_module
+from itertools import groupby
 import logging
 import os
+import queue
 import sys
+import threading
+import time
 
+from sqlalchemy import bindparam
 from sqlalchemy import Boolean
+from sqlalchemy import cast
 from sqlalchemy import Column
 from sqlalchemy import create_engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Float
+from sqlalchemy import func
+from sqlalchemy import Index
+from sqlalchemy import insert
 from sqlalchemy import inspect
 from sqlalchemy import Integer
+from sqlalchemy import literal
+from sqlalchemy import literal_column
+from sqlalchemy import MetaData
 from sqlalchemy.orm import Query
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy import select
 from sqlalchemy import String
+from sqlalchemy import Table as SATable
+from sqlalchemy import tuple_
+from sqlalchemy import update
 
 
 LOCAL_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)))
@@ -22,10 +44,11 @@ SCRIPTS_DIR = os.path.join(LOCAL_DIR, '..', 'scripts')
 sys.path.append(SCRIPTS_DIR)
 
 
-from file import load_file  # noqa: E402
+from file import iter_file  # noqa: E402
 from file import validate_schema  # noqa: E402
 from text import snake_to_pascal  # noqa: E402
 from utils import jsearch  # noqa: E402
+from utils import now  # noqa: E402
 
 
 TYPES = {
@@ -54,9 +77,177 @@ MIGRATION_TABLE = {
     ]
 }
 
+AGGREGATES = {
+    'avg': func.avg,
+    'count': func.count,
+    'max': func.max,
+    'min': func.min,
+    'sum': func.sum
+}
+BATCH_SIZE = 400
+LATEST_CACHE_SIZE = 10
+SEED_CHUNK_SIZE = 1000
+SEED_PROGRESS = 50000
+SORTS = ('asc', 'desc')
+STATEMENT_CACHE_SIZE = 128
+
+DBS = {}
+DBS_LOCK = threading.Lock()
+
+
+class WriteQueue(object):
+    """A single writer thread for a database.
+
+    Callers submit write operations, callables that take a Session, and get
+    a Future back. Whatever is queued when the writer wakes up is run in one
+    transaction and committed together, each operation in its own savepoint
+    so one bad operation only rolls back and fails its own future. If the
+    commit itself fails, each operation is retried on its own.
+    """
+    def __init__(self, engine, max_size=1000, max_batch=100):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.logger = logging.getLogger('WriteQueue')
+        self.queue = queue.Queue(maxsize=max_size)
+        self.lock = threading.Lock()
+        self.stats = {
+            'commits': 0,
+            'operations': 0,
+            'failures': 0,
+            'last_batch': 0,
+            'max_batch': 0,
+            'last_commit_ms': 0.0,
+            'max_commit_ms': 0.0,
+            'total_commit_ms': 0.0
+        }
+        self.thread = threading.Thread(
+            target=self._run, name='WriteQueue', daemon=True)
+        self.thread.start()
+
+    def submit(self, operation):
+        """Queue an operation, blocking while the queue is full."""
+        future = Future()
+        self.queue.put((operation, future))
+
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._commit(batch)
+
+    def _commit(self, batch):
+        start = time.perf_counter()
+        results = []
+        try:
+            with Session(self.engine) as session:
+                if self.engine.dialect.name == 'sqlite':
+                    # pysqlite only opens transactions before DML, so begin
+                    # explicitly to keep the savepoints in one transaction.
+                    session.connection().exec_driver_sql('BEGIN')
+
+                for operation, _ in batch:
+                    results.append(self._run_operation(session, operation))
+
+                session.commit()
+
+        except Exception as e:
+            if len(batch) == 1:
+                with self.lock:
+                    self.stats['failures'] += 1
+
+                batch[0][1].set_exception(e)
+            else:
+                self.logger.warning(
+                    f'Batch of {len(batch)} failed, retrying singly: {e}')
+                for item in batch:
+                    self._commit([item])
+
+            return
+
+        self._record(len(batch), (time.perf_counter() - start) * 1000)
+        for (_, future), (result, error) in zip(batch, results):
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def _run_operation(self, session, operation):
+        try:
+            with session.begin_nested():
+                result = operation(session)
+        except Exception as e:
+            with self.lock:
+                self.stats['failures'] += 1
+
+            return None, e
+
+        # Later operations may change the same rows through Core statements,
+        # so reload ORM objects instead of trusting the identity map.
+        session.expire_all()
+
+        return result, None
+
+    def _record(self, size, elapsed):
+        with self.lock:
+            self.stats['commits'] += 1
+            self.stats['operations'] += size
+            self.stats['last_batch'] = size
+            self.stats['max_batch'] = max(self.stats['max_batch'], size)
+            self.stats['last_commit_ms'] = elapsed
+            self.stats['max_commit_ms'] = max(
+                self.stats['max_commit_ms'], elapsed)
+            self.stats['total_commit_ms'] += elapsed
+
+    def metrics(self):
+        """Queue depth, commit latency (ms) and batch size stats."""
+        with self.lock:
+            out = dict(self.stats)
+
+        commits = out.pop('commits')
+        total = out.pop('total_commit_ms')
+        out.update({
+            'depth': self.queue.qsize(),
+            'commits': commits,
+            'avg_batch': out['operations'] / commits if commits else 0,
+            'avg_commit_ms': total / commits if commits else 0.0
+        })
+
+        return out
+
+
+def build_column(column):
+    _type = TYPES.get(column['type'], String)
+    _type_args = column.get('type_args', [])
+
+    if _type_args:
+        _type = _type(*_type_args)
+
+    kwargs = column.get('kwargs', {})
+
+    return Column(column['name'], _type, **kwargs)
+
+
+def run_write(engine, operation, writer=None):
+    """Run a write operation through the writer if set, else commit it."""
+    if writer is not None and threading.current_thread() is not writer.thread:
+        return writer.submit(operation).result()
+
+    with Session(engine) as session:
+        out = operation(session)
+        session.commit()
+
+    return out
+
 
 class Table(object):
-    def __init__(self, name, columns, engine):
+    def __init__(self, name, columns, engine, writer=None):
         validate_schema(
             columns,
             schema_file=os.path.join(
@@ -67,37 +258,67 @@ class Table(object):
         self.logger = logging.getLogger(f'Table: {snake_to_pascal(self.name)}')
         self.engine = engine
         self._build_table(columns)
-        self.errors = []
+        # Tables are shared across threads (see get_db), so errors are
+        # collected per thread and the caches are guarded by a lock.
+        self.local = threading.local()
+        self.cache_lock = threading.Lock()
+        self.statements = {}
+        self.row_types = {}
+        self.writer = writer
+        self.latest_lock = threading.Lock()
+        self.latest_rows = None
+        self.latest_complete = False
+        self.generation = 0
 
     def _build_table(self, columns):
         base = declarative_base()
         cls_name = snake_to_pascal(self.name)
         cfg = {'__tablename__': self.name}
+        indexes = []
         for column in columns:
-            _type = TYPES.get(column['type'], String)
-            _type_args = column.get('type_args', [])
-
-            if _type_args:
-                _type = _type(*_type_args)
+            if 'index' in column:
+                indexes.append(Index(
+                    column['name'],
+                    *column['index'],
+                    unique=column.get('unique', False)
+                ))
+                continue
 
-            kwargs = column.get('kwargs', {})
-            cfg[column['name']] = Column(_type, **kwargs)
+            cfg[column['name']] = build_column(column)
 
+        self.fields = [k for k in cfg.keys() if k != '__tablename__']
+        cfg['__table_args__'] = tuple(indexes)
         self.table = type(cls_name, (base, ), cfg)
         base.metadata.create_all(self.engine)
+
+        # create_all skips existing tables, so add any new indexes as well
+        for index in self.table.__table__.indexes:
+            index.create(self.engine, checkfirst=True)
+
         self.pks = [f.key for f in inspect(self.table).primary_key]
-        self.fields = [k for k in cfg.keys() if k != '__tablename__']
+
+    @property
+    def errors(self):
+        errors = getattr(self.local, 'errors', None)
+        if errors is None:
+            errors = self.local.errors = []
+
+        return errors
+
+    @errors.setter
+    def errors(self, value):
+        self.local.errors = value
 
     def _error(self, name=None, raise_ex=False):
-        if self.errors:
+        errors = self.errors
+        if errors:
+            self.errors = []
             if raise_ex is True:
-                raise Exception(f'Error(s) on {name} method: {self.errors}')
+                raise Exception(f'Error(s) on {name} method: {errors}')
             else:
-                for e in self.errors:
+                for e in errors:
                     self.logger.error(f'Error on {name} method: {e}')
 
-            self.errors = []
-
     def _deserialize(self, query_result, fields=None):
         def _deserialize_item(item, keys):
             return {
@@ -125,49 +346,51 @@ class Table(object):
 
         return [f for f in fields if f in self.fields]
 
-    def _generate_filter(self, query, _filter):
-        if not _filter:
-            return query
+    def _filter_shape(self, _filter, params):
+        """Split a filter into a hashable shape and its bound values.
 
-        def add_args(_filter, args=None, key=None):
-            if not args:
-                args = []
+        Values are added to params under the bind names in the shape. None
+        stays in the shape itself so `__eq__` still renders `IS NULL`.
+        """
+        shape = []
 
-            column = getattr(self.table, key) if key else None
-            if key and key not in self.fields:
-                self.errors.append(
-                    f'{key} is not a valid field for filtering.')
+        for k, v in sorted(_filter.items()):
+            key = k[:-4] if k.endswith('__op') else k
+            ops = sorted(v.items()) if isinstance(v, dict) else [('__eq__', v)]
 
-                return args
+            for op, value in ops:
+                if value is None:
+                    shape.append((key, op, None, False))
+                    continue
 
-            if isinstance(_filter, dict):
-                if not key:
-                    for k, v in _filter.items():
-                        _key = k[:-4] if k.endswith('__op') else k
-                        args = add_args(v, args, _key)
-                else:
-                    for k, v in _filter.items():
-                        args.append(getattr(column.comparator, k)(v))
+                expanding = isinstance(value, (list, tuple, set))
+                name = f'{key}_{len(params)}'
+                params[name] = list(value) if expanding else value
+                shape.append((key, op, name, expanding))
 
-            else:
-                args.append(getattr(column.comparator, '__eq__')(_filter))
+        return tuple(shape)
 
-            return args
+    def _generate_filter(self, shape, columns=None):
+        columns = columns if columns else self.table.__table__.c
+        args = []
 
-        args = add_args(_filter)
+        for key, op, name, expanding in shape:
+            if key not in columns:
+                self.errors.append(
+                    f'{key} is not a valid field for filtering.')
+                continue
 
-        return query.filter(*args)
+            value = bindparam(name, expanding=expanding) if name else None
 
-    def _select_fields(self, query, fields):
-        fields = self._validate_fields(fields)
-        args = [
-            getattr(self.table, field)
-            for field in fields
-        ]
+            try:
+                args.append(getattr(columns[key].comparator, op)(value))
+            except Exception as e:
+                self.errors.append(f'Invalid filter {op} on {key}: {e}')
 
-        return query.add_columns(*args)
+        return args
 
-    def _sort_query(self, query, sort):
+    def _parse_sort(self, sort, columns=None):
+        columns = columns if columns else self.table.__table__.c
         direction = 'asc'
         err = f'Invalid sort in query: {sort}'
 
@@ -180,16 +403,55 @@ class Table(object):
             direction = sort[1].lower() if len(sort) > 1 else direction
         else:
             self.errors.append(err)
-            return query
+            return None, None
 
-        if not field or field not in self.fields:
+        if not field or field not in columns or direction not in SORTS:
             self.errors.append(err)
-            return query
+            return None, None
 
-        field = getattr(self.table, field)
-        direction = getattr(field, direction)
+        return columns[field], direction
 
-        return query.order_by(direction())
+    def _sort_query(self, sort, columns=None):
+        column, direction = self._parse_sort(sort, columns)
+
+        return getattr(column, direction)() if column is not None else None
+
+    def _stable_sort(self, sort):
+        # Break ties on the primary key so keyset pages line up
+        column, direction = self._parse_sort(sort)
+        if column is None:
+            return []
+
+        order = [getattr(column, direction)()]
+        if len(self.pks) == 1 and column.key != self.pks[0]:
+            pk = self.table.__table__.c[self.pks[0]]
+            order.append(getattr(pk, direction)())
+
+        return order
+
+    def _keyset(self, sort):
+        """Select rows after the row keyed by the `after` param.
+
+        Rows follow the order of _stable_sort. Comparing (field, key) row
+        values against that row keeps deep pages as cheap as the first.
+        """
+        if len(self.pks) != 1:
+            self.errors.append('Keyset pagination needs a single primary key.')
+            return None
+
+        pk = self.table.__table__.c[self.pks[0]]
+        column, direction = self._parse_sort(sort) if sort else (pk, 'asc')
+        if column is None:
+            return None
+
+        after = bindparam('after')
+        if column.key == pk.key:
+            return pk > after if direction == 'asc' else pk < after
+
+        last = select(column, pk).where(pk == after).scalar_subquery()
+        keys = tuple_(column, pk)
+
+        return keys > last if direction == 'asc' else keys < last
 
     def _validate_limit(self, limit):
         err = f'Invalid query limit: {limit}'
@@ -204,7 +466,64 @@ class Table(object):
 
         return 'all'
 
-    def _get(self, ids, session=None, ignore_err=False):
+    def _cached_statement(self, key):
+        with self.cache_lock:
+            return self.statements.get(key)
+
+    def _cache_statement(self, key, value):
+        # Don't cache invalid queries so their errors are reported each time
+        if not self.errors:
+            with self.cache_lock:
+                if len(self.statements) >= STATEMENT_CACHE_SIZE:
+                    self.statements.clear()
+
+                self.statements[key] = value
+
+    def _compile_query(self, fields, _filter, sort, limit, after=None):
+        """Get a (cached) select statement, its fields and bound params.
+
+        Statements are cached by query shape (fields, filter keys and
+        operators, sort, limit, paging), so repeated queries skip
+        validation and statement building and only bind new values.
+        """
+        params = {}
+        shape = self._filter_shape(_filter, params) if _filter else ()
+        key = (
+            tuple(fields) if isinstance(fields, list) else fields,
+            shape,
+            tuple(sorted(sort.items())) if isinstance(sort, dict) else sort,
+            limit,
+            after is not None
+        )
+        if after is not None:
+            params['after'] = after
+
+        cached = self._cached_statement(key)
+
+        if cached:
+            return cached + (params, )
+
+        fields = self._validate_fields(fields)
+        columns = self.table.__table__.c
+        stmt = select(*[columns[f] for f in fields])
+        stmt = stmt.where(*self._generate_filter(shape)) if shape else stmt
+
+        if after is not None:
+            condition = self._keyset(sort)
+            stmt = stmt.where(condition) if condition is not None else stmt
+            sort = sort if sort else self.pks[0]
+
+        if sort:
+            stmt = stmt.order_by(*self._stable_sort(sort))
+
+        limit = self._validate_limit(limit)
+        stmt = stmt.limit(limit) if isinstance(limit, int) else stmt
+
+        self._cache_statement(key, (stmt, fields, limit))
+
+        return stmt, fields, limit, params
+
+    def _pk_values(self, ids, ignore_err=False):
         err = 'Not all primary keys provided.'
         pks = None
 
@@ -221,10 +540,14 @@ class Table(object):
         elif len(self.pks) == 1:
             pks = (ids, )
 
-        if not pks:
-            if not ignore_err:
-                self.errors.append(err)
+        if not pks and not ignore_err:
+            self.errors.append(err)
+
+        return pks
 
+    def _get(self, ids, session=None, ignore_err=False):
+        pks = self._pk_values(ids, ignore_err)
+        if not pks:
             return None
 
         if session:
@@ -233,7 +556,34 @@ class Table(object):
         with Session(self.engine) as session:
             return session.get(self.table, pks)
 
-    def get(self, ids, fields=None, raise_ex=False, return_field_value=None):
+    def _row_type(self, fields):
+        """A named tuple class for rows of the given fields (cached)."""
+        fields = tuple(fields)
+        with self.cache_lock:
+            row_type = self.row_types.get(fields)
+            if row_type is None:
+                row_type = namedtuple(f'{self.table.__name__}Row', fields)
+                self.row_types[fields] = row_type
+
+        return row_type
+
+    def get(self, ids, fields=None, raise_ex=False, return_field_value=None,
+            compact=False):
+        if compact is True:
+            pks = self._pk_values(ids)
+            if not pks:
+                self._error('get', raise_ex)
+                return None
+
+            return self.query(
+                fields,
+                dict(zip(self.pks, pks)),
+                limit=1,
+                raise_ex=raise_ex,
+                return_field_value=return_field_value,
+                compact=True
+            )
+
         data = self._get(ids)
         if not data:
             return None
@@ -252,54 +602,242 @@ class Table(object):
         return data
 
     def query(self, fields=None, _filter=None, sort=None, limit=None,
-              raise_ex=False, return_field_value=None):
+              raise_ex=False, return_field_value=None, compact=False,
+              after=None):
+        """Select rows as dicts.
+
+        With compact=True rows are immutable named tuples built straight
+        from the cursor rows, which are smaller and quicker to make, and a
+        missing single row (limit=1) is None instead of {}.
+        For keyset pagination pass the primary key of the last row of the
+        previous page as after, with the same sort and filter.
+        """
         if return_field_value and limit and limit == 1:
             fields = return_field_value
 
-        query = Query(self.table)
-        query = self._generate_filter(query, _filter) if _filter else query
-        query = self._select_fields(query, fields) if fields else query
-        query = self._sort_query(query, sort) if sort else query
-        limit = self._validate_limit(limit)
+        stmt, fields, limit, params = self._compile_query(
+            fields, _filter, sort, limit, after)
 
-        with Session(self.engine) as session:
-            if isinstance(limit, int):
-                if limit == 1:
-                    data = query.with_session(session).limit(1).all()
-                    data = data[0] if data else {}
-                else:
-                    data = query.with_session(session).limit(limit).all()
+        with self.engine.connect() as conn:
+            result = conn.execute(stmt, params)
+            if compact is True:
+                data = list(map(self._row_type(fields)._make, result))
             else:
-                data = query.with_session(session).all()
+                data = [dict(zip(fields, row)) for row in result]
+
+        if limit == 1:
+            data = data[0] if data else ({} if compact is not True else None)
 
         self._error('query', raise_ex)
 
-        data = self._deserialize(data, fields)
         if limit == 1 and return_field_value and data:
-            data = data.get(return_field_value)
+            if compact is True:
+                data = getattr(data, return_field_value, None)
+            else:
+                data = data.get(return_field_value)
 
         return data
 
-    def upsert(self, record, raise_ex=False):
-        ok = False
-        try:
-            with Session(self.engine) as session:
-                current = self._get(record, session, ignore_err=True)
-                if current:
-                    for field, value in record.items():
-                        if field not in self.pks:
-                            setattr(current, field, value)
+    def iter_query(self, fields=None, _filter=None, sort=None, limit=None,
+                   chunk_size=None, raise_ex=False, compact=False,
+                   after=None):
+        """Like query, but yields rows as they are fetched from the cursor.
+
+        Rows are pulled chunk_size at a time, so memory use doesn't grow
+        with the size of the table.
+        """
+        if not isinstance(chunk_size, int) or chunk_size < 1:
+            chunk_size = BATCH_SIZE
+
+        stmt, fields, limit, params = self._compile_query(
+            fields, _filter, sort, limit, after)
+        self._error('iter_query', raise_ex)
+
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                stmt, params)
+
+            make = self._row_type(fields)._make if compact is True else None
+            for chunk in result.partitions(chunk_size):
+                for row in chunk:
+                    yield make(row) if make else dict(zip(fields, row))
+
+    def _group_by(self, group_by):
+        groups = {}
+
+        for group in group_by if isinstance(group_by, list) else [group_by]:
+            if isinstance(group, str):
+                group = {'field': group}
+
+            field = group.get('field') if isinstance(group, dict) else None
+            if field not in self.fields:
+                self.errors.append(f'Invalid group by: {group}')
+                continue
+
+            expr = self.table.__table__.c[field]
+            bucket = group.get('bucket')
+            if bucket:
+                expr = cast(expr / bucket, Integer) * bucket
+
+            name = group.get('name', field)
+            groups[name] = expr.label(name)
+
+        return groups
+
+    def _metrics(self, metrics):
+        out = {}
+        if not isinstance(metrics, dict):
+            self.errors.append(f'Invalid metrics: {metrics}')
+            return out
+
+        for name, metric in metrics.items():
+            if not (
+                isinstance(metric, (list, tuple))
+                and len(metric) == 2
+                and all(isinstance(m, str) for m in metric)
+            ):
+                self.errors.append(f'Invalid metric {name}: {metric}')
+                continue
+
+            fn, field = metric
+            if fn not in AGGREGATES or (
+                field not in self.fields and (fn, field) != ('count', '*')
+            ):
+                self.errors.append(f'Invalid metric {name}: {fn}({field})')
+                continue
+
+            if field == '*':
+                out[name] = AGGREGATES[fn]().label(name)
+            else:
+                field = self.table.__table__.c[field]
+                out[name] = AGGREGATES[fn](field).label(name)
 
-                else:
-                    item = self.table(**record)
-                    session.add(item)
+        return out
 
-                session.commit()
+    def aggregate(self, group_by=None, metrics=None, _filter=None,
+                  having=None, sort=None, limit=None, raise_ex=False):
+        """Run aggregations in the database.
+
+        group_by is a field, a dict with a field, a numeric bucket size and
+        an output name (e.g. tx_timestamp by day) or a list of those.
+        metrics maps output names to (function, field) pairs, e.g.
+        {'total': ('sum', 'amount'), 'txs': ('count', '*')}. _filter uses
+        the query filter language on table fields, having and sort use it
+        on the group and metric names.
+        """
+        params = {}
+        shape = self._filter_shape(_filter, params) if _filter else ()
+        having_shape = self._filter_shape(having, params) if having else ()
+        key = (
+            'aggregate',
+            repr(group_by),
+            repr(metrics),
+            shape,
+            having_shape,
+            repr(sort),
+            limit
+        )
+        cached = self._cached_statement(key)
+
+        if cached:
+            stmt, names = cached
+        else:
+            groups = self._group_by(group_by) if group_by else {}
+            labels = dict(groups, **self._metrics(metrics or {}))
+            names = list(labels.keys())
+            stmt = select(*labels.values())
+            stmt = stmt.where(*self._generate_filter(shape)) if shape else stmt
+            stmt = stmt.group_by(*groups.values()) if groups else stmt
+
+            if having_shape:
+                exprs = {k: v.element for k, v in labels.items()}
+                stmt = stmt.having(
+                    *self._generate_filter(having_shape, exprs))
+
+            if sort:
+                order = self._sort_query(sort, labels)
+                stmt = stmt.order_by(order) if order is not None else stmt
+
+            limit = self._validate_limit(limit)
+            stmt = stmt.limit(limit) if isinstance(limit, int) else stmt
+
+            if not names:
+                self.errors.append('No valid groups or metrics to aggregate.')
+
+            self._cache_statement(key, (stmt, names))
+
+        data = None
+        if not self.errors:
+            try:
+                with self.engine.connect() as conn:
+                    data = [
+                        dict(zip(names, row))
+                        for row in conn.execute(stmt, params)
+                    ]
+
+            except Exception as e:
+                self.errors.append(f'Error on aggregate: {e}')
 
+        self._error('aggregate', raise_ex)
+
+        return data
+
+    def _written(self):
+        # Called after every write through this table, failed or not
+        with self.latest_lock:
+            self.generation += 1
+            self.latest_rows = None
+
+    def latest(self, limit=1, return_field_value=None, raise_ex=False):
+        """The newest rows by primary key, like query(sort='<pk>,desc').
+
+        The newest LATEST_CACHE_SIZE (or limit, if more) rows are cached
+        until the next write through this table, so polling the latest
+        rows doesn't query the database. Callers get copies.
+        """
+        with self.latest_lock:
+            rows = self.latest_rows
+            generation = self.generation
+            complete = self.latest_complete
+
+        if rows is None or (limit > len(rows) and not complete):
+            size = max(limit, LATEST_CACHE_SIZE)
+            rows = self.query(
+                sort=f'{self.pks[0]},desc', limit=size, raise_ex=raise_ex)
+            with self.latest_lock:
+                # Don't keep rows read before a concurrent write
+                if generation == self.generation:
+                    self.latest_rows = rows
+                    self.latest_complete = len(rows) < size
+
+        rows = [dict(row) for row in rows[:limit]]
+        if limit == 1:
+            row = rows[0] if rows else {}
+            return row.get(return_field_value) if return_field_value else row
+
+        return rows
+
+    def upsert(self, record, raise_ex=False):
+        def _upsert(session):
+            current = self._get(record, session, ignore_err=True)
+            if current:
+                for field, value in record.items():
+                    if field not in self.pks:
+                        setattr(current, field, value)
+
+            else:
+                item = self.table(**record)
+                session.add(item)
+
+        ok = False
+        try:
+            run_write(self.engine, _upsert, self.writer)
             ok = True
         except Exception as e:
             self.errors.append(f'Error upserting {record}: {e}')
 
+        self._written()
+
         self._error('upsert', raise_ex)
 
         return ok
@@ -315,18 +853,148 @@ class Table(object):
         else:
             try:
                 items = [self.table(**record) for record in records]
-                with Session(self.engine) as session:
-                    session.bulk_save_objects(items)
-                    session.commit()
-
+                run_write(
+                    self.engine,
+                    lambda session: session.bulk_save_objects(items),
+                    self.writer
+                )
                 ok = True
             except Exception as e:
                 self.errors.append(f'Error on bulk insert: {e}')
 
+            self._written()
+
         self._error('bulk_insert', raise_ex)
 
         return ok
 
+    def _existing_keys(self, conn, keys):
+        pk_cols = [self.table.__table__.c[pk] for pk in self.pks]
+        keys = [k for k in keys if None not in k]
+
+        if not keys:
+            return set()
+
+        if len(pk_cols) == 1:
+            clause = pk_cols[0].in_([k[0] for k in keys])
+        else:
+            clause = tuple_(*pk_cols).in_(keys)
+
+        rows = conn.execute(select(*pk_cols).where(clause))
+
+        return set(tuple(r) for r in rows)
+
+    def _upsert_batch(self, conn, batch, seen, counts):
+        table = self.table.__table__
+        keys = [tuple(r.get(pk) for pk in self.pks) for r in batch]
+        existing = self._existing_keys(conn, keys) | seen
+
+        for key in keys:
+            if None in key:
+                counts['inserted'] += 1
+                continue
+
+            counts['updated' if key in existing else 'inserted'] += 1
+            existing.add(key)
+            seen.add(key)
+
+        # executemany needs the same fields in every row of a statement
+        groups = {}
+        for record in batch:
+            groups.setdefault(tuple(sorted(record.keys())), []).append(record)
+
+        for fields, group in groups.items():
+            stmt = sqlite_insert(table)
+            updates = {
+                f: stmt.excluded[f]
+                for f in fields
+                if f not in self.pks
+            }
+            if updates:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=self.pks, set_=updates)
+            else:
+                stmt = stmt.on_conflict_do_nothing(index_elements=self.pks)
+
+            conn.execute(stmt, group)
+
+    def bulk_upsert(self, records, batch_size=None, raise_ex=False):
+        """Insert or update records with INSERT ... ON CONFLICT DO UPDATE.
+
+        Records are written in batches of batch_size within one transaction.
+        Returns {'inserted': int, 'updated': int}, or None on error.
+        """
+        out = None
+
+        if isinstance(records, dict):
+            records = [records]
+
+        if not isinstance(batch_size, int) or batch_size < 1:
+            batch_size = BATCH_SIZE
+
+        if not isinstance(records, list):
+            self.errors.append(f'Invalid bulk upsert payload: {records}')
+        else:
+            try:
+                def _bulk_upsert(session):
+                    counts = {'inserted': 0, 'updated': 0}
+                    seen = set()
+                    conn = session.connection()
+                    for i in range(0, len(records), batch_size):
+                        self._upsert_batch(
+                            conn, records[i:i + batch_size], seen, counts)
+
+                    return counts
+
+                out = run_write(self.engine, _bulk_upsert, self.writer)
+            except Exception as e:
+                out = None
+                self.errors.append(f'Error on bulk upsert: {e}')
+
+            self._written()
+
+        self._error('bulk_upsert', raise_ex)
+
+        return out
+
+    def add_counts(self, records, field, raise_ex=False):
+        """Add the field of each record to its row, inserting missing rows.
+
+        Records hold the primary key fields and field. This is one
+        INSERT ... ON CONFLICT DO UPDATE SET field = field + excluded.field.
+        """
+        ok = False
+
+        if isinstance(records, dict):
+            records = [records]
+
+        if not isinstance(records, list):
+            self.errors.append(f'Invalid add counts payload: {records}')
+        else:
+            table = self.table.__table__
+            stmt = sqlite_insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=self.pks,
+                set_={field: table.c[field] + stmt.excluded[field]}
+            )
+            try:
+                if records:
+                    run_write(
+                        self.engine,
+                        lambda session: session.execute(stmt, records),
+                        self.writer
+                    )
+
+                ok = True
+            except Exception as e:
+                self.errors.append(f'Error adding counts to {field}: {e}')
+
+            self._written()
+
+        self._error('add_counts', raise_ex)
+
+        return ok
+
     def count(self, raise_ex=False):
         out = None
         try:
@@ -343,29 +1011,283 @@ class Table(object):
 
 class DB(object):
     def __init__(self, _type, path=None, tables=None, seeds=None,
-                 migrations=None):
+                 migrations=None, engine=None):
         _tables = deepcopy(MIGRATION_TABLE)
         tables = {} if not isinstance(tables, dict) else tables
         _tables.update(tables)
         seeds = {} if not isinstance(seeds, dict) else seeds
         migrations = {} if not isinstance(migrations, dict) else migrations
+        engine = {} if not isinstance(engine, dict) else engine
         validate_schema(
-            {'tables': _tables, 'seeds': seeds, 'migrations': migrations},
+            {
+                'tables': _tables,
+                'seeds': seeds,
+                'migrations': migrations,
+                'engine': engine
+            },
             schema_file=os.path.join(
                 LOCAL_DIR, '..', 'data', 'schemas', 'sql_db.yaml'),
             raise_ex=True
         )
 
-        self.engine = create_engine(f'sqlite:///{path}')
+        self.logger = logging.getLogger('DB')
+        engine_kwargs = {}
+        if _type == 'sqlite' and path:
+            # Keep a pool of open connections for file DBs (sqlalchemy 1.4
+            # defaults to NullPool, i.e. a new connection per checkout).
+            engine_kwargs = {
+                'poolclass': QueuePool,
+                'connect_args': {'check_same_thread': False}
+            }
+
+        self.engine = create_engine(f'{_type}:///{path}', **engine_kwargs)
+        if _type == 'sqlite' and engine.get('pragmas'):
+            self._set_pragmas(engine['pragmas'])
+
+        self.writer = None
+        if 'write_queue' in engine:
+            self.writer = WriteQueue(self.engine, **engine['write_queue'])
+
         self.tables = []
 
         for name, columns in _tables.items():
-            setattr(self, name, Table(name, columns, self.engine))
+            setattr(
+                self, name, Table(name, columns, self.engine, self.writer))
             self.tables.append(name)
 
         self.process_seeds(seeds)
         self.process_migrations(migrations, _tables)
 
+    def _set_pragmas(self, pragmas):
+        # Pragmas are per connection, so apply them to every new one.
+        # Keys and values are restricted by the sql_db schema.
+        @event.listens_for(self.engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for key, value in pragmas.items():
+                cursor.execute(f'PRAGMA {key}={value}')
+
+            cursor.close()
+
+    def _error(self, msg, raise_ex=False):
+        if raise_ex is True:
+            raise Exception(msg)
+
+        self.logger.error(msg)
+
+    def transfer(self, payer, payee, amount, memo=None, ts=None, mint=False,
+                 return_balances=False, raise_ex=False):
+        """Debit payer, credit payee and log the tx in one commit.
+
+        Works on the `balance` and `transaction` tables. The debit is a
+        conditional UPDATE so the funds check and the write can't interleave
+        with another writer. With mint=True the payer is outside the ledger
+        (e.g. `None` for pool deposits) and is not debited. Both balance
+        versions are bumped. With a write queue the commit may be shared
+        with other queued writes.
+        Returns 'NSF' if the payer can't cover the amount, otherwise a bool,
+        or with return_balances=True the committed {user: balance} of the
+        payer and payee instead of True.
+        """
+        balance = self.balance.table.__table__
+        tx = self.transaction.table.__table__
+
+        def _transfer(session):
+            if mint is not True:
+                debit = session.execute(
+                    update(balance)
+                    .where(balance.c.user == payer)
+                    .where(balance.c.balance >= amount)
+                    .values(
+                        balance=balance.c.balance - amount,
+                        version=balance.c.version + 1
+                    )
+                )
+                if debit.rowcount != 1:
+                    return 'NSF'
+
+            credit = session.execute(
+                update(balance)
+                .where(balance.c.user == payee)
+                .values(
+                    balance=balance.c.balance + amount,
+                    version=balance.c.version + 1
+                )
+            )
+            if credit.rowcount != 1:
+                session.execute(insert(balance).values(
+                    user=payee, balance=amount, version=1))
+
+            session.execute(insert(tx).values(
+                payer_id=payer,
+                payee_id=payee,
+                amount=amount,
+                memo=memo,
+                tx_timestamp=ts if ts else now()
+            ))
+
+            if return_balances is True:
+                return dict(session.execute(
+                    select(balance.c.user, balance.c.balance)
+                    .where(balance.c.user.in_([payer, payee]))
+                ).all())
+
+            return True
+
+        out = False
+        try:
+            out = run_write(self.engine, _transfer, self.writer)
+        except Exception as e:
+            self._error(
+                f'Error on transfer of {amount} from {payer} to {payee}: {e}',
+                raise_ex
+            )
+        finally:
+            self.balance._written()
+            self.transaction._written()
+
+        return out
+
+    def set_balance(self, user, amount, version=None, raise_ex=False):
+        """Set a user's balance and bump its version.
+
+        Works on the `balance` table. With version set this is a
+        compare-and-set: it only applies while the row is still at that
+        version, a missing row counting as version 0. New rows start at 1.
+        Returns 'CONFLICT' if the version moved, otherwise a bool.
+        """
+        balance = self.balance.table.__table__
+
+        def _set_balance(session):
+            stmt = (
+                update(balance)
+                .where(balance.c.user == user)
+                .values(balance=amount, version=balance.c.version + 1)
+            )
+            if version is not None:
+                stmt = stmt.where(balance.c.version == version)
+
+            if session.execute(stmt).rowcount == 1:
+                return True
+
+            if version:
+                return 'CONFLICT'
+
+            added = session.execute(
+                sqlite_insert(balance)
+                .values(user=user, balance=amount, version=1)
+                .on_conflict_do_nothing(index_elements=['user'])
+            )
+
+            return True if added.rowcount == 1 else 'CONFLICT'
+
+        out = False
+        try:
+            out = run_write(self.engine, _set_balance, self.writer)
+        except Exception as e:
+            self._error(
+                f'Error setting balance of {user} to {amount}: {e}', raise_ex)
+        finally:
+            self.balance._written()
+
+        return out
+
+    def add_column(self, table_name, column, raise_ex=False):
+        """Add a column to an existing table with ALTER TABLE ADD COLUMN.
+
+        column is a column config as in the table yaml files. Existing rows
+        get its default. Does nothing if the column already exists.
+        """
+        ok = False
+        try:
+            existing = [
+                c['name']
+                for c in inspect(self.engine).get_columns(table_name)
+            ]
+            if column['name'] not in existing:
+                _column = build_column(column)
+                ddl = str(CreateColumn(_column).compile(
+                    dialect=self.engine.dialect))
+                default = column.get('kwargs', {}).get('default')
+                if default is not None:
+                    default = literal(default).compile(
+                        dialect=self.engine.dialect,
+                        compile_kwargs={'literal_binds': True}
+                    )
+                    ddl += f' DEFAULT {default}'
+
+                with self.engine.begin() as conn:
+                    conn.exec_driver_sql(
+                        f'ALTER TABLE "{table_name}" ADD COLUMN {ddl}')
+
+            ok = True
+        except Exception as e:
+            self._error(
+                f'Error adding {column["name"]} to {table_name}: {e}',
+                raise_ex
+            )
+
+        return ok
+
+    def copy_table(self, table_name, columns, transform=None,
+                   chunk_size=None):
+        """Rebuild a table with a new config, in constant memory.
+
+        Rows are copied into a new table under a temp name in chunks of
+        chunk_size, one transaction per chunk, optionally passed through
+        transform (a function of a row dict returning the new row). The
+        old table is then dropped and the new one renamed in a single
+        transaction, and indexes are created after the swap. A failed copy
+        leaves the old table untouched. Returns the new Table.
+        """
+        if not isinstance(chunk_size, int) or chunk_size < 1:
+            chunk_size = BATCH_SIZE
+
+        temp_name = f'{table_name}_tmp'
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(f'DROP TABLE IF EXISTS "{temp_name}"')
+
+        # Index names are global in SQLite, so they wait for the swap
+        temp = Table(
+            temp_name, [c for c in columns if 'index' not in c], self.engine)
+        new = temp.table.__table__
+        old = SATable(table_name, MetaData(), autoload_with=self.engine)
+        fields = [c.name for c in old.columns if c.name in new.c]
+        rowid = literal_column('rowid')
+        last = None
+        copied = 0
+
+        while True:
+            with self.engine.begin() as conn:
+                stmt = select(rowid, *[old.c[f] for f in fields])
+                if last is not None:
+                    stmt = stmt.where(rowid > last)
+
+                rows = conn.execute(
+                    stmt.order_by(rowid).limit(chunk_size)).all()
+                if not rows:
+                    break
+
+                last = rows[-1][0]
+                records = [dict(zip(fields, row[1:])) for row in rows]
+                if transform:
+                    records = [transform(r) for r in records]
+
+                conn.execute(insert(new), records)
+                copied += len(records)
+
+        with self.engine.begin() as conn:
+            # pysqlite only opens transactions before DML, so begin
+            # explicitly to keep the DDL swap atomic.
+            conn.exec_driver_sql('BEGIN')
+            conn.exec_driver_sql(f'DROP TABLE "{table_name}"')
+            conn.exec_driver_sql(
+                f'ALTER TABLE "{temp_name}" RENAME TO "{table_name}"')
+
+        self.logger.info(f'Copied {copied} rows into the new {table_name}.')
+
+        return Table(table_name, columns, self.engine, self.writer)
+
     def get_migration_state(self, _id):
         state = self.migration.get(_id, return_field_value='completed')
         if not isinstance(state, bool):
@@ -388,6 +1310,7 @@ class DB(object):
                     script = getattr(module, script_id)
                     completed, table = script(
                         self, table_name, tables[table_name])
+                    table.writer = self.writer
                     setattr(self, table_name, table)
                     self.migration.upsert(
                         {'id': migration_id, 'completed': completed})
@@ -405,16 +1328,87 @@ class DB(object):
                         if isinstance(info, list):
                             insert = table.bulk_insert(info)
                         elif isinstance(info, dict):
-                            if 'file' in info:
-                                load_kwargs = info.get('load_kwargs', {})
-                                data = load_file(info['file'], **load_kwargs)
-                            else:
-                                data = info.get('data', [])
+                            insert = self._seed_table(table, info)
 
-                            transform = info.get('transform')
-                            if transform:
-                                data = jsearch(transform, data)
+        return insert
 
-                            insert = table.bulk_insert(data)
+    def _seed_table(self, table, info):
+        """Stream a seed into an empty table in one transaction.
+
+        Rows are read, transformed and inserted chunk_size at a time, so
+        the transform has to map each row on its own (e.g. `[].{...}`).
+        """
+        chunk_size = info.get('chunk_size', SEED_CHUNK_SIZE)
+        if 'file' in info:
+            chunks = iter_file(
+                info['file'],
+                chunk_size=chunk_size,
+                **info.get('load_kwargs', {})
+            )
+        else:
+            data = info.get('data', [])
+            chunks = (
+                data[i:i + chunk_size]
+                for i in range(0, len(data), chunk_size)
+            )
+
+        transform = info.get('transform')
+        stmt = insert(table.table.__table__)
+        start = time.perf_counter()
+
+        def _seed(session):
+            rows = 0
+            for chunk in chunks:
+                if transform:
+                    chunk = jsearch(transform, chunk)
+
+                # An executemany takes its columns from the first row, so
+                # rows with different keys go in separate statements and
+                # missing columns keep their defaults.
+                for i in range(0, len(chunk), chunk_size):
+                    for _, group in groupby(
+                            chunk[i:i + chunk_size], key=frozenset):
+                        session.execute(stmt, list(group))
+
+                seeded = rows + len(chunk)
+                if seeded // SEED_PROGRESS > rows // SEED_PROGRESS:
+                    self._log_seed(table.name, seeded, start)
+
+                rows = seeded
+
+            return rows
 
-        return insert
+        ok = False
+        try:
+            rows = run_write(self.engine, _seed, self.writer)
+            self._log_seed(table.name, rows, start, done=True)
+            ok = True
+        except Exception as e:
+            self._error(f'Error seeding {table.name}: {e}')
+
+        return ok
+
+    def _log_seed(self, name, rows, start, done=False):
+        elapsed = time.perf_counter() - start
+        rate = rows / elapsed if elapsed else 0
+        status = 'Seeded' if done else 'Seeding'
+        self.logger.info(
+            f'{status} {name}: {rows} rows in {elapsed:.1f}s '
+            f'({rate:.0f} rows/sec)'
+        )
+
+
+def get_db(_type, path=None, config=None):
+    """Get the process-wide DB for a path, creating it on first use.
+
+    config is a dict of DB kwargs (tables, seeds, migrations) or a callable
+    that returns one, so it is only loaded when the DB doesn't exist yet.
+    """
+    key = (_type, os.path.realpath(path) if path else None)
+
+    with DBS_LOCK:
+        if key not in DBS:
+            config = config() if callable(config) else config
+            DBS[key] = DB(_type, path, **(config or {}))
+
+        return DBS[key]
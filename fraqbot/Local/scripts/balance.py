@@ -0,0 +1,15 @@
+import logging
+
+
+def add_version_field(db, table_name, table_cfg):
+    completed = False
+    table = getattr(db, table_name)
+
+    try:
+        version = [t for t in table_cfg if t['name'] == 'version'][0]
+        completed = db.add_column(table_name, version, raise_ex=True)
+    except Exception as e:
+        msg = f'Error running add_version_field migration:\n{e}'
+        logging.getLogger().error(msg)
+
+    return completed, table
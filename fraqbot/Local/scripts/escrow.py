@@ -1,18 +1,15 @@
 import logging
 
-from Local.helpers.sql import Table
+from sqlalchemy import update
 
 
 def add_paid_field(db, table_name, table_cfg):
     completed = False
+    table = getattr(db, table_name)
+
     try:
         paid = [t for t in table_cfg if t['name'] == 'paid'][0]
-        table_cfg = [t for t in table_cfg if t['name'] != 'paid']
-        table = Table(table_name, table_cfg, db.engine)
-        records = table.query(sort={'field': 'id'})
-        table.table.__table__.drop(db.engine)
-        table_cfg.append(paid)
-        table = Table(table_name, table_cfg, db.engine)
+        db.add_column(table_name, paid, raise_ex=True)
 
         latest_group = db.pool_history.query(
             limit=1,
@@ -21,11 +18,14 @@ def add_paid_field(db, table_name, table_cfg):
         )
         latest_group = str(latest_group) if latest_group else ''
 
-        for record in records:
-            if record['escrow_group_id'] != latest_group:
-                record['paid'] = True
+        escrow = table.table.__table__
+        with db.engine.begin() as conn:
+            conn.execute(
+                update(escrow)
+                .where(escrow.c.escrow_group_id != latest_group)
+                .values(paid=True)
+            )
 
-        table.bulk_insert(records)
         completed = True
     except Exception as e:
         msg = f'Error running add_paid_field migration:\n{e}'
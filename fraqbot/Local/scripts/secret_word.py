@@ -1,25 +1,28 @@
 import logging
 
-from Local.helpers.sql import Table
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import update
 
 
 def add_completed_field(db, table_name, table_cfg):
     completed = False
+    table = getattr(db, table_name)
 
     try:
-        completed = [t for t in table_cfg if t['name'] == 'completed'][0]
-        table_cfg = [t for t in table_cfg if t['name'] != 'completed']
-        table = Table(table_name, table_cfg, db.engine)
-        records = table.query(sort={'field': 'id'})
-        table.table.__table__.drop(db.engine)
-        table_cfg.append(completed)
-        table = Table(table_name, table_cfg, db.engine)
+        column = [t for t in table_cfg if t['name'] == 'completed'][0]
+        db.add_column(table_name, column, raise_ex=True)
 
-        for i, record in enumerate(records):
-            if i != len(records) - 1:
-                record['completed'] = True
+        # Every word but the current one is completed
+        secret_word = table.table.__table__
+        latest = select(func.max(secret_word.c.id)).scalar_subquery()
+        with db.engine.begin() as conn:
+            conn.execute(
+                update(secret_word)
+                .where(secret_word.c.id < latest)
+                .values(completed=True)
+            )
 
-        table.bulk_insert(records)
         completed = True
     except Exception as e:
         msg = f'Error running add_completed_field migraction:\n{e}'
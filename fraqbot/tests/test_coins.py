@@ -0,0 +1,751 @@
+from collections import Counter
+from datetime import datetime
+import os
+from random import Random
+import re
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+from Legobot.Lego import Lego
+
+FRAQBOT_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..')
+LOCAL_PATH = os.path.join(FRAQBOT_PATH, 'Local')
+for path in [FRAQBOT_PATH, LOCAL_PATH]:
+    if path not in sys.path:
+        sys.path.append(path)
+
+from coins import Coins  # noqa: E402
+from coins import CoinsAdmin  # noqa: E402
+from coins import CoinsPoolManager  # noqa: E402
+from coins import CoinsSecretWord  # noqa: E402
+from coins import POOL_RETRY  # noqa: E402
+from helpers.coins import account_locks  # noqa: E402
+from helpers.coins import account_stripe  # noqa: E402
+from helpers.scheduler import Scheduler  # noqa: E402
+from helpers import utils  # noqa: E402
+
+LOCK = threading.Lock()
+BASEPLATE = Lego.start(None, LOCK)
+DAY = 86400
+START = 1600000000
+
+
+def _admin(tmp_path):
+    return CoinsAdmin(BASEPLATE, LOCK, tx_dir=str(tmp_path))
+
+
+def _synthetic_ledger(db, users=60, days=120, seed=42):
+    rand = Random(seed)
+    users = [f'U{i:09d}' for i in range(users)]
+    db.pool_history.bulk_insert([
+        {
+            'id': d,
+            'fillup_ts': START + d * DAY,
+            'next_fillup_ts': START + (d + 1) * DAY,
+            'amount': 500
+        }
+        for d in range(1, days + 1)
+    ])
+    escrow = []
+    txs = []
+
+    for d in range(1, days):
+        for user in rand.sample(users, len(users) // 3):
+            amount = rand.choice((5, 10, 15))
+            escrow.append({
+                'escrow_group_id': str(d),
+                'tx_timestamp': START + d * DAY + 60,
+                'payer_id': 'escrow',
+                'payee_id': user,
+                'amount': amount,
+                'memo': 'Mining :pick:'
+            })
+            # Paid out later that period, sometimes more than once
+            for i in range(rand.choice((1, 1, 1, 2))):
+                txs.append({
+                    'tx_timestamp': START + d * DAY + 3600 + i,
+                    'payer_id': 'escrow',
+                    'payee_id': user,
+                    'amount': amount,
+                    'memo': 'Happy Moin!'
+                })
+
+    rand.shuffle(txs)
+    db.escrow.bulk_insert(escrow)
+    db.transaction.bulk_insert(txs)
+    db.balance.bulk_upsert([
+        {'user': user, 'balance': 1000}
+        for user in users + ['escrow', 'pool']
+    ])
+
+
+def _legacy_dedupe(db):
+    """The per-user dedupe this replaced, kept as a reference"""
+    users = [
+        u['user'] for u in db.balance.query(fields=['user'])
+        if u['user'].startswith('U')
+    ]
+    out = []
+
+    for user in users:
+        payouts = db.transaction.query(
+            _filter={
+                'payer_id': 'escrow',
+                'payee_id': user,
+                'memo': 'Happy Moin!'
+            },
+            sort={'field': 'tx_timestamp'}
+        )
+        dupes = []
+
+        while payouts:
+            tx = payouts.pop(0)
+            amt = tx['amount']
+
+            if len(payouts) >= 2 and payouts[1]['amount'] == amt:
+                dupes.append([tx, payouts.pop(1)])
+
+            if payouts and payouts[0]['amount'] == amt:
+                dupes.append([tx, payouts.pop(0)])
+
+        for (first, second) in dupes:
+            grps = [db.pool_history.query(
+                _filter={'fillup_ts__op': {'__ge__': first['tx_timestamp']}},
+                limit=1,
+                return_field_value='id'
+            ) - 1]
+            grps.append(grps[-1] - 1)
+            grps.append(db.pool_history.query(
+                _filter={'fillup_ts__op': {'__ge__': second['tx_timestamp']}},
+                limit=1,
+                return_field_value='id'
+            ) - 1)
+            grps.append(grps[-1] - 1)
+            found = db.escrow.query(
+                _filter={
+                    'escrow_group_id': {'in_': [str(g) for g in grps]},
+                    'payee_id': user,
+                    'amount': first['amount']
+                }
+            )
+            if len(found) == 1:
+                out.append((first, second))
+
+    return out
+
+
+def test_dedupe_matches_legacy(tmp_path):
+    admin = _admin(tmp_path)
+    _synthetic_ledger(admin.db)
+
+    start = time.perf_counter()
+    expected = _legacy_dedupe(admin.db)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    users = [u['user'] for u in admin.db.balance.query(fields=['user'])]
+    users = [u for u in users if u.startswith('U')]
+    dupes = admin._check_dupes_against_escrow(
+        admin._get_duplicate_escrow_payouts(
+            admin._get_escrow_payouts(users)))
+    single_pass = time.perf_counter() - start
+
+    print(f'\ndedupe on {admin.db.transaction.count()} txs: '
+          f'legacy {legacy:.3f}s, single pass {single_pass:.3f}s')
+    assert expected
+    assert [(a['id'], b['id']) for a, b in dupes] == [
+        (a['id'], b['id']) for a, b in expected]
+
+
+def test_handle_dedupe(tmp_path):
+    admin = _admin(tmp_path)
+    _synthetic_ledger(admin.db, users=10, days=20)
+    dupes = len(_legacy_dedupe(admin.db))
+    message = {'metadata': {'source_user': 'admin'}}
+
+    response = admin._handle_dedupe(message, [])
+    assert len(response.splitlines()) == dupes + 1
+    assert admin.db.transaction.aggregate(
+        metrics={'n': ('count', '*')},
+        _filter={'memo': 'Happy Moin! DUPLICATE. CORRECTED.'}
+    ) == [{'n': dupes}]
+    assert admin._handle_dedupe(message, ['<@nobody>']) == (
+        'No duplicate transactions to correct.')
+
+
+def test_dedupe_watermark(tmp_path):
+    admin = _admin(tmp_path)
+    _synthetic_ledger(admin.db, users=10, days=20)
+    message = {'metadata': {'source_user': 'admin'}}
+    admin._handle_dedupe(message, [])
+    last = admin.db.transaction.query(
+        _filter={'memo__op': {'startswith': 'Happy Moin!'}},
+        sort='tx_timestamp,desc',
+        limit=1
+    )
+    watermark = admin.db.watermark.get('dedupe')
+    assert watermark == {
+        'id': 'dedupe',
+        'tx_id': last['id'],
+        'tx_timestamp': last['tx_timestamp']
+    }
+
+    # Only payouts after the watermark (minus the overlap) are scanned
+    user = 'U000000001'
+    since = admin._get_dedupe_since()
+    assert since == last['tx_timestamp'] - 3 * DAY
+    payouts = admin._get_escrow_payouts([user], since)
+    assert payouts[user]
+    assert all(tx['tx_timestamp'] >= since for tx in payouts[user])
+
+    # New duplicate payouts are found on the next incremental run
+    ts = START + 20 * DAY + 60
+    admin.db.pool_history.upsert({
+        'id': 21,
+        'fillup_ts': START + 21 * DAY,
+        'next_fillup_ts': START + 22 * DAY,
+        'amount': 500
+    })
+    admin.db.escrow.upsert({
+        'escrow_group_id': '20',
+        'tx_timestamp': ts,
+        'payer_id': 'escrow',
+        'payee_id': user,
+        'amount': 999,
+        'memo': 'Mining :pick:'
+    })
+    admin._deposit('escrow', 2000, 'escrow deposit')
+    for i in range(2):
+        assert admin._pay('escrow', user, 999, 'Happy Moin!') is True
+        admin.db.transaction.upsert({
+            'id': admin.db.transaction.query(
+                limit=1, sort='id,desc', return_field_value='id'),
+            'tx_timestamp': ts + 3600 + i
+        })
+
+    response = admin._handle_dedupe(message, [])
+    assert response.splitlines()[1:] == [
+        f'- <@{user}> received 999 from escrow for Happy Moin!.']
+    assert admin.db.watermark.get(
+        'dedupe', return_field_value='tx_timestamp') == ts + 3601
+
+
+def test_pay_stress_conserves_coins(tmp_path):
+    admin = _admin(tmp_path)
+    users = [f'U{i:09d}' for i in range(20)]
+    admin.db.balance.bulk_upsert([
+        {'user': user, 'balance': 100} for user in users])
+    paid = []
+
+    def tip(seed):
+        rand = Random(seed)
+        for _ in range(100):
+            payer, payee = rand.sample(users, 2)
+            paid.append(admin._pay(payer, payee, rand.randint(1, 40)))
+
+    threads = [threading.Thread(target=tip, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    results = Counter(paid)
+    balances = {
+        b['user']: b['balance'] for b in admin.db.balance.query()}
+    assert sum(results.values()) == 1600
+    assert results[True] and results['NSF']
+    assert sum(balances[u] for u in users) == 2000
+    assert min(balances.values()) >= 0
+    assert all(admin._get_balance(u) == balances[u] for u in users)
+    assert admin.db.transaction.count() == results[True]
+
+
+def test_pay_cache_load_after_commit(tmp_path, monkeypatch):
+    admin = _admin(tmp_path)
+    admin.db.balance.bulk_upsert([
+        {'user': 'U000000001', 'balance': 100},
+        {'user': 'U000000002', 'balance': 0}
+    ])
+    admin.balance_cache.invalidate()
+    transfer = admin.db.transfer
+
+    def load_after_commit(*args, **kwargs):
+        # Another lego loads the cache between the commit and the cache
+        # update, so it already sees the committed balances
+        out = transfer(*args, **kwargs)
+        admin.balance_cache.get('U000000001')
+        return out
+
+    monkeypatch.setattr(admin.db, 'transfer', load_after_commit)
+    assert admin._pay('U000000001', 'U000000002', 10) is True
+    assert admin._get_balance('U000000001') == 90
+    assert admin._get_balance('U000000002') == 10
+
+
+def test_pay_disjoint_accounts(tmp_path):
+    admin = _admin(tmp_path)
+    users = {}
+    for i in range(100):
+        users.setdefault(account_stripe(f'U{i:09d}'), f'U{i:09d}')
+
+    a, b, c, d = list(users.values())[:4]
+    admin.db.balance.bulk_upsert([
+        {'user': user, 'balance': 10} for user in (a, b, c, d)])
+    done = {}
+
+    def pay(payer, payee):
+        done[payer] = admin._pay(payer, payee, 1)
+
+    with account_locks(a, b):
+        disjoint = threading.Thread(target=pay, args=(c, d))
+        overlapping = threading.Thread(target=pay, args=(d, a))
+        disjoint.start()
+        disjoint.join(5)
+        overlapping.start()
+        overlapping.join(0.2)
+        assert done == {c: True}
+
+    overlapping.join(5)
+    assert done == {c: True, d: True}
+
+
+def test_optimistic_balances(tmp_path):
+    admin = CoinsAdmin(
+        BASEPLATE,
+        LOCK,
+        tx_dir=str(tmp_path),
+        optimistic_balances=True,
+        balance_retries=100
+    )
+    admin._update_balance('pot', 0)
+    start = admin.conflict_stats.stats()
+
+    def add(n):
+        return lambda balance: balance + n
+
+    threads = [
+        threading.Thread(target=lambda: [
+            admin._update_balance('pot', add(1)) for _ in range(25)])
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    stats = admin.conflict_stats.stats()
+    assert admin._get_balance('pot') == 200
+    assert stats['exhausted'] == start['exhausted']
+    assert stats['writes'] - start['writes'] == 200 + (
+        stats['conflicts'] - start['conflicts'])
+
+    # A write landing between the read and the compare-and-set is retried
+    seen = []
+
+    def bump(balance):
+        if not seen:
+            admin._deposit('pot', 5, 'interloper')
+
+        seen.append(balance)
+        return balance * 2
+
+    assert admin._update_balance('pot', bump) is True
+    assert seen == [200, 205]
+    assert admin._get_balance('pot') == 410
+    assert admin.conflict_stats.stats()['conflicts'] == stats['conflicts'] + 1
+
+    admin.balance_retries = 0
+    seen.clear()
+    assert admin._update_balance('pot', bump) is False
+    assert admin.conflict_stats.stats()['exhausted'] == stats['exhausted'] + 1
+
+    # A constant only creates a missing balance and is never retried over
+    # another writer's changes
+    admin.balance_retries = 5
+    assert admin._update_balance('pot', 0) is False
+    assert admin._get_balance('pot') == 415
+
+    user = 'U000000001'
+    update = admin.db.set_balance
+
+    def created_first(*args, **kwargs):
+        # Another writer creates and tips the user before our insert
+        admin.db.set_balance = update
+        update(user, 20)
+        admin._deposit(user, 5, 'tip')
+        return update(*args, **kwargs)
+
+    admin.db.set_balance = created_first
+    conflicts = admin.conflict_stats.stats()['conflicts']
+    assert admin._get_balance(user, True) == 25
+    assert admin.db.balance.get(user, return_field_value='balance') == 25
+    assert admin.conflict_stats.stats()['conflicts'] == conflicts + 1
+    assert admin.db.transaction.query(
+        _filter={'payee_id': user, 'memo': 'Starting Balance'}) == []
+
+
+def test_history(tmp_path):
+    coins = Coins(BASEPLATE, LOCK, tx_dir=str(tmp_path))
+    user = 'U000000001'
+    coins._deposit(user, 100, 'seed', START)
+    for i in range(20):
+        coins._pay(user, 'U000000002', 1, f'tip {i}')
+        coins._pay('U000000002', user, 1)
+
+    coins._pay('U000000003', 'U000000002', 1)
+    message = {'metadata': {'source_user': user}}
+    ids = []
+    params = []
+
+    while True:
+        lines = coins._handle_history(message, params).splitlines()
+        ids += [int(line.split('`')[1]) for line in lines[1:16]]
+        if not lines[-1].startswith('More:'):
+            break
+
+        params = [lines[-1].split()[-1].strip('`')]
+
+    assert ids == list(range(41, 0, -1))
+    day = datetime.utcfromtimestamp(coins.db.transaction.get(
+        2, return_field_value='tx_timestamp')).strftime('%Y-%m-%d')
+    assert coins._format_history(user, 3).splitlines() == [
+        f'Transactions for <@{user}>:',
+        f'• `2` {day}: sent 1 Coins to <@U000000002> (tip 0)',
+        '• `1` 2020-09-13: received 100 Coins from None (seed)'
+    ]
+    assert coins._format_history(user, 1) == 'No more transactions.'
+    assert coins._handle_history(message, ['x']) == (
+        'x is not a valid transaction ID.')
+    assert coins._format_history('U000000009') == 'No transactions.'
+
+
+def _secret_word_lego(tmp_path, properties):
+    return CoinsSecretWord(
+        BASEPLATE, LOCK, tx_dir=str(tmp_path), defaults={'pool_excludes': []},
+        secret_word_channels=[], properties=properties
+    )
+
+
+def _legacy_word_pool(users, messages, common_words):
+    """The history word pool extraction this replaced, as a reference"""
+    user_search = ('[?contains([{}], user) '
+                   '&& !contains(lower(text), `moin`) '
+                   '&& !starts_with(text, `!ak`)]').format(
+        ', '.join([f'`{u}`' for u in users])
+    )
+    messages = utils.jsearch(user_search, messages)
+    word_pool = {}
+
+    for message in messages:
+        user = message['user']
+        if user not in word_pool:
+            word_pool[user] = []
+
+        word_pool[user] += re.findall(r':[a-zA-Z0-9_-]+:', message['text'])
+        string = re.sub(
+            r'(:[a-zA-Z0-9_-]+:)|(<@U[A-Z0-9]+>)', '', message['text'])
+        string = re.sub(r'\S+\.\S+', '', string)
+        words = re.findall(r'\b\w+\b', string)
+        word_pool[user] += [
+            w.lower() for w in words
+            if len(w) > 3
+            and w.lower() not in common_words
+        ]
+
+    return word_pool
+
+
+def test_secret_word_candidates(tmp_path):
+    coins = Coins(BASEPLATE, LOCK, tx_dir=str(tmp_path))
+    coins.db.secret_word.upsert({'ts': START, 'secret_word': 'seed'})
+    users = [f'U00000000{i}' for i in range(4)]
+    for user in users:
+        coins._get_balance(user, True)
+
+    lego = _secret_word_lego(tmp_path, [{'name': 'common_words',
+                                         'data': ['About']}])
+    assert lego.secret_word == 'seed'
+    assert lego.matcher.words == ['seed']
+    lego.secret_word_channels = ['C1']
+    lego.candidates_since = START
+
+    def message(user, text, channel='C1'):
+        # Legobot rewrites mentions in text, metadata.text stays raw
+        return {
+            'text': re.sub(r'<@U[A-Z0-9]+>', '@Sally', text),
+            'metadata': {
+                'text': text, 'source_channel': channel, 'source_user': user}
+        }
+
+    lego.listening_for(message(users[0], 'Talk about Widgets :tada:'))
+    lego.listening_for(message(users[1], 'see <@U000000009> gadgets.io'))
+    lego.listening_for(message(users[1], 'gadgets'))
+    lego.listening_for(message(users[2], 'moin sprockets'))
+    lego.listening_for(message(users[2], '!ak gizmos'))
+    lego.listening_for(message(users[2], 'more doohickeys', 'C2'))
+    lego.listening_for(message('B000000001', 'thingamajigs'))
+    assert lego.candidates == {1: {
+        users[0]: ['talk', 'widgets', ':tada:'],
+        users[1]: ['gadgets']
+    }}
+
+    lego.listening_for(message(users[3], 'rotors'))
+    lego._set_secret_word(True)
+    record = lego.db.secret_word.latest()
+    assert record['id'] == 2 and lego.secret_id == 2
+    assert (record['secret_word'], record['source_user']) in [
+        (':tada:', users[0]), ('talk', users[0]), ('widgets', users[0]),
+        ('gadgets', users[1]), ('rotors', users[3])
+    ]
+    assert lego.candidates[2] == {}
+    text = f'so {record["secret_word"]}!'
+    assert lego.listening_for(message(users[0], text)) == (
+        record['secret_word'])
+
+
+def test_secret_word_extraction_benchmark(tmp_path, monkeypatch):
+    Coins(BASEPLATE, LOCK, tx_dir=str(tmp_path)).db.secret_word.upsert(
+        {'ts': START, 'secret_word': 'seed'})
+    lego = _secret_word_lego(tmp_path, [{'name': 'common_words', 'file': {
+        'path': 'data/lists/common_words.txt', 'raw': True,
+        'split_lines': True, 'default': []}}])
+    common_words = [w.lower() for w in lego.common_words]
+    assert 'about' in lego.common_words
+
+    rand = Random(7)
+    vocab = common_words + [
+        'Widget', 'gadgets', 'sprocket', 'cat', 'doohickey', ':tada:',
+        ':white_check_mark:', '<@U000000001>', 'example.com', 'v1.2',
+        '<https://x.io/a.b|link>', 'MOIN', 'rotor_blade', 'gizmo!'
+    ]
+    users = [f'U{i:09d}' for i in range(30)]
+    messages = []
+    for _ in range(10000):
+        text = ' '.join(rand.choices(vocab, k=rand.randint(3, 25)))
+        if rand.random() < 0.05:
+            text = f'!ak {text}'
+
+        messages.append({'user': rand.choice(users), 'text': text})
+
+    monkeypatch.setattr(
+        utils, 'call_slack_api', lambda *args, **kwargs: messages)
+    lego.botThread = SimpleNamespace(slack_client=None)
+    lego.secret_word_channels = ['C1']
+    pool_users = users[:10]
+
+    start = time.perf_counter()
+    legacy = _legacy_word_pool(pool_users, messages, common_words)
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    pool = lego._get_history_word_pool(pool_users, START)
+    pool_time = time.perf_counter() - start
+
+    print(f'\n{len(messages)} messages: legacy {legacy_time:.3f}s, '
+          f'single pass {pool_time:.3f}s')
+    assert {u: Counter(w) for u, w in pool.items()} == {
+        u: Counter(w) for u, w in legacy.items()}
+    assert pool_time < legacy_time
+
+
+def test_next_fillup():
+    # Saturday before the DST change goes to Monday 08:30 EDT
+    assert CoinsPoolManager._get_next_fillup(1710000000) == 1710160200
+    # Late Thursday Eastern, already Friday in UTC, goes to Friday morning
+    assert CoinsPoolManager._get_next_fillup(1730426400) == 1730464200
+    assert datetime.utcfromtimestamp(1730464200).isoformat() == (
+        '2024-11-01T12:30:00')
+
+
+def _pool_manager(tmp_path):
+    """A CoinsPoolManager after its first (overdue) fill-up"""
+    defaults = {
+        'participant_channels': [],
+        'disbursement_channels': [],
+        'pool_excludes': ['U000000009']
+    }
+    manager = CoinsPoolManager(
+        BASEPLATE, LOCK, tx_dir=str(tmp_path), defaults=defaults)
+    deadline = time.time() + 5
+    while manager.pool_job.due < time.time():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    return manager
+
+
+def test_pool_manager_schedules_fillups(tmp_path):
+    manager = _pool_manager(tmp_path)
+    fillup = manager.db.pool_history.latest()
+    assert fillup['next_fillup_ts'] == manager._get_next_fillup(
+        fillup['fillup_ts'])
+    assert manager._get_balance('pool') == (
+        manager.starting_value + fillup['amount'])
+    assert manager.listening_for({'text': 'hello'}) is False
+    assert manager.pool_job.due == fillup['next_fillup_ts']
+    assert manager.pool_job in manager.scheduler.pending()
+
+    manager.on_stop()
+    assert manager.pool_job not in manager.scheduler.pending()
+
+
+class EagerScheduler(Scheduler):
+    """Lets overdue jobs run before schedule() returns to the caller"""
+    def schedule(self, due, func, *args, **kwargs):
+        job = super().schedule(due, func, *args, **kwargs)
+        if due <= time.time():
+            time.sleep(0.2)
+
+        return job
+
+
+def test_pool_manager_tracks_rescheduled_job(tmp_path, monkeypatch):
+    scheduler = EagerScheduler()
+    monkeypatch.setattr(
+        sys.modules['coins'], 'get_scheduler', lambda: scheduler)
+    manager = _pool_manager(tmp_path)
+
+    # The overdue fill-up ran and rescheduled itself while __init__ was
+    # still scheduling it, the handle has to be the rescheduled job
+    assert manager.pool_job.due == manager.next_pool > time.time()
+    assert manager.pool_job in scheduler.pending()
+
+    manager.on_stop()
+    assert scheduler.pending() == []
+
+
+def test_pool_participants(tmp_path):
+    manager = _pool_manager(tmp_path)
+    manager.participant_channels = ['C1']
+    # U000000004 is a bot posting as_user
+    manager.botThread = SimpleNamespace(
+        users_by_id={'U000000004': {'is_bot': True}, 'U000000001': {}},
+        get_user_name_by_id=lambda *args, **kwargs: None
+    )
+
+    def message(user, channel='C1', subtype=None):
+        return {'text': 'hi', 'metadata': {
+            'source_user': user, 'source_channel': channel,
+            'subtype': subtype}}
+
+    for user, n in [('U000000001', 3), ('U000000002', 1), ('U000000009', 2)]:
+        for _ in range(n):
+            manager.listening_for(message(user))
+
+    manager.listening_for(message('U000000003', 'C2'))
+    manager.listening_for(message('U000000003', subtype='bot_message'))
+    manager.listening_for(message('B000000001'))
+    manager.listening_for(message('U000000004'))
+    manager._flush_participants()
+    manager.listening_for(message('U000000001'))
+    assert manager.db.participant.get(
+        (1, 'U000000001'), return_field_value='messages') == 3
+    assert manager.db.participant.get((1, 'U000000004')) is None
+    assert manager.bot_users['U000000004'] is True
+
+    # Rows of bots counted before are skipped at payout
+    manager.db.participant.add_counts(
+        {'pool_id': 1, 'user': 'U000000004', 'messages': 9}, 'messages')
+
+    assert manager._get_participants(1, None) == {
+        'U000000001': 4, 'U000000002': 1}
+    assert manager.participants == Counter()
+
+    manager._deposit('pool', 1000, 'test deposit')
+    payees = {}
+    manager._announce_payments = payees.update
+    manager._pay_participants(1)
+    assert set(payees) == {'U000000001', 'U000000002'}
+    manager.on_stop()
+
+
+def test_pool_payout_switches_period(tmp_path):
+    manager = _pool_manager(tmp_path)
+    manager.participant_channels = ['C1']
+    manager.botThread = SimpleNamespace(
+        users_by_id={}, get_user_name_by_id=lambda *args, **kwargs: None)
+    manager._announce_payments = lambda payees: None
+    pool_id = manager.pool_id
+    manager.db.participant.add_counts(
+        {'pool_id': pool_id, 'user': 'U000000002', 'messages': 1},
+        'messages')
+    get_participants = manager._get_participants
+
+    def get_participants_and_chat(*args):
+        # A message arriving after the final flush of the paid pool
+        participants = get_participants(*args)
+        manager.listening_for({'text': 'hi', 'metadata': {
+            'source_user': 'U000000001', 'source_channel': 'C1'}})
+
+        return participants
+
+    manager._get_participants = get_participants_and_chat
+    manager.next_pool = 0
+    manager._update_pool()
+    manager._flush_participants()
+
+    assert manager.pool_id == pool_id + 1
+    assert manager.db.pool_history.latest(return_field_value='id') == (
+        pool_id + 1)
+    assert manager.db.participant.query(
+        fields='pool_id,messages', _filter={'user': 'U000000001'}) == [
+        {'pool_id': pool_id + 1, 'messages': 1}]
+
+    # The paid pool isn't paid again
+    manager.next_pool = 0
+    manager._update_pool()
+    assert manager.paid.count(pool_id) == 1
+    manager.on_stop()
+
+
+def test_pool_fillup_retries(tmp_path):
+    manager = _pool_manager(tmp_path)
+    manager._announce_payments = lambda payees: None
+    manager.db.participant.add_counts(
+        {'pool_id': manager.pool_id, 'user': 'U000000001', 'messages': 1},
+        'messages')
+    next_pool = manager.next_pool
+    deposit = manager._deposit
+    manager._deposit = lambda *args: False
+    manager.next_pool = time.time() - 10
+
+    # A failed deposit retries in POOL_RETRY seconds, not at the next fill-up
+    manager._run_pool_job()
+    assert manager.next_pool < time.time()
+    assert manager.pool_job.due <= time.time() + POOL_RETRY + 1
+    assert len(manager.paid) == 2
+    pool = manager._get_balance('pool')
+
+    # So does a failed history write, without depositing twice
+    manager._deposit = deposit
+    manager.db.pool_history.upsert = lambda record: False
+    manager._run_pool_job()
+    assert manager.next_pool < time.time()
+    deposited = manager._get_balance('pool') - pool
+    assert deposited > 0
+
+    del manager.db.pool_history.upsert
+    manager._run_pool_job()
+    assert manager.next_pool == manager.pool_job.due == next_pool
+    assert manager._get_balance('pool') - pool == deposited
+    assert len(manager.paid) == 2
+    assert manager.db.pool_history.latest()['amount'] == deposited
+    manager.on_stop()
+
+
+def test_draw_participants():
+    weights = {'a': 1, 'b': 3, 'c': 6}
+    firsts = Counter()
+    for _ in range(5000):
+        order = list(CoinsPoolManager._draw_participants(weights))
+        assert sorted(order) == ['a', 'b', 'c']
+        firsts[order[0]] += 1
+
+    for user, weight in weights.items():
+        assert abs(firsts[user] / 5000 - weight / 10) < 0.04
+
+
+BASEPLATE.stop()
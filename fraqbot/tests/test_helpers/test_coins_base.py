@@ -0,0 +1,75 @@
+import os
+import sys
+
+
+LOCAL_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)),
+    '..',
+    '..',
+    'Local'
+)
+if LOCAL_DIR not in sys.path:
+    sys.path.append(LOCAL_DIR)
+
+TABLES_DIR = os.path.join(LOCAL_DIR, 'data', 'tables')
+
+
+from helpers.coins import BalanceCache  # noqa: E402
+from helpers.coins import SecretWordMatcher  # noqa: E402
+from helpers import file  # noqa: E402
+from helpers.sql import DB  # noqa: E402
+
+
+def _ledger_db(tmp_path):
+    tables = {}
+    for name in ['balance', 'transaction']:
+        tables.update(file.load_file(os.path.join(TABLES_DIR, f'{name}.yaml')))
+
+    return DB('sqlite', tmp_path / 'tx.sqlite', tables)
+
+
+def test_balance_cache(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.balance.upsert({'user': 'bob', 'balance': 10})
+    cache = BalanceCache(db.balance)
+
+    assert cache.get('bob') == 10
+    assert cache.get('bob') == 10
+    assert cache.get('larry') is None
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'users': 1}
+
+    # Writers set the balances they committed
+    balances = db.transfer('bob', 'larry', 4, return_balances=True)
+    assert balances == {'bob': 6, 'larry': 4}
+    for user, balance in balances.items():
+        cache.set(user, balance)
+
+    assert cache.get('bob') == 6
+    assert cache.get('larry') == 4
+
+    # Out of band changes are only seen after invalidation
+    db.balance.upsert({'user': 'bob', 'balance': 100})
+    assert cache.get('bob') == 6
+    cache.invalidate('bob')
+    assert cache.get('bob') == 100
+    assert cache.stats()['misses'] == 2
+
+    db.balance.upsert({'user': 'sally', 'balance': 7})
+    cache.invalidate()
+    assert cache.get('sally') == 7
+    assert cache.stats()['misses'] == 3
+
+
+def test_secret_word_matcher():
+    matcher = SecretWordMatcher('Secret', ':tada:', 'e.g.', None)
+    assert matcher.words == ['secret', ':tada:', 'e.g.']
+    assert matcher.match('The SECRET, revealed!') == 'secret'
+    assert matcher.match('ask the secretary') is None
+    assert matcher.match('secret_sauce') is None
+    assert matcher.match('nice :tada: work') == ':tada:'
+    assert matcher.match('tada') is None
+    assert matcher.match('E.g. this') == 'e.g.'
+    assert matcher.match('see.g.') is None
+    assert matcher.match(':tada: my secret') == 'secret'
+    assert matcher.match(None) is None
+    assert SecretWordMatcher().match('secret') is None
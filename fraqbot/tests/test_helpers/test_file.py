@@ -0,0 +1,104 @@
+import json
+import os
+import sys
+
+import pytest
+
+
+HELPERS_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)),
+    '..',
+    '..',
+    'Local',
+    'helpers'
+)
+if HELPERS_DIR not in sys.path:
+    sys.path.append(HELPERS_DIR)
+
+
+import file  # noqa: E402
+
+
+def test_iter_file_csv(tmp_path):
+    path = tmp_path / 'tx.csv'
+    lines = ['Payer|Payee|Amount'] + [f'U{i}|U{i + 1}|{i}' for i in range(7)]
+    path.write_text('\n'.join(lines))
+
+    chunks = list(file.iter_file(str(path), delimiter='|', chunk_size=3))
+    assert [len(c) for c in chunks] == [3, 3, 1]
+    assert chunks[2] == [{'Payer': 'U6', 'Payee': 'U7', 'Amount': '6'}]
+
+
+def test_iter_file_json(tmp_path):
+    rows = [{'user': f'U{i}', 'balance': i} for i in range(5)]
+    path = tmp_path / 'rows.jsonl'
+    path.write_text('\n'.join(json.dumps(r) for r in rows) + '\n\n')
+    assert list(file.iter_file(str(path), chunk_size=2)) == [
+        rows[:2], rows[2:4], rows[4:]]
+
+    path = tmp_path / 'rows.json'
+    path.write_text(json.dumps(rows))
+    assert list(file.iter_file(str(path), chunk_size=4)) == [
+        rows[:4], rows[4:]]
+
+    path = tmp_path / 'balances.json'
+    path.write_text(json.dumps({'U1': 5, 'U2': 10}))
+    assert list(file.iter_file(str(path))) == [{'U1': 5, 'U2': 10}]
+
+
+def _write_schemas(tmp_path, item_type='integer'):
+    (tmp_path / 'item.yaml').write_text(
+        f'type: object\nproperties:\n  n:\n    type: {item_type}\n')
+    main = tmp_path / 'main.yaml'
+    main.write_text(
+        'type: object\nproperties:\n  item:\n    $file: ./item.yaml\n')
+
+    return str(main)
+
+
+def test_load_schema_cached(tmp_path, monkeypatch):
+    path = _write_schemas(tmp_path)
+    loads = []
+    load_file = file.load_file
+
+    def counting_load_file(*args, **kwargs):
+        loads.append(args[0])
+        return load_file(*args, **kwargs)
+
+    monkeypatch.setattr(file, 'load_file', counting_load_file)
+
+    schema = file.load_schema(path)
+    assert schema['$defs']['item']['_main']['properties']['n'] == {
+        'type': 'integer'}
+    assert len(loads) == 2
+
+    # Cached, and callers get their own copy
+    schema['properties'] = {}
+    assert file.load_schema(path)['properties'] == {
+        'item': {'$ref': '#/$defs/item/_main'}}
+    assert len(loads) == 2
+
+    # Changing a referenced file reloads the schema
+    _write_schemas(tmp_path, 'string')
+    item = tmp_path / 'item.yaml'
+    mtime = item.stat().st_mtime_ns + 10 ** 9
+    os.utime(item, ns=(mtime, mtime))
+    schema = file.load_schema(path)
+    assert schema['$defs']['item']['_main']['properties']['n'] == {
+        'type': 'string'}
+    assert len(loads) == 4
+
+
+def test_validate_schema_reuses_validator(tmp_path):
+    path = _write_schemas(tmp_path)
+
+    assert file.validate_schema({'item': {'n': 1}}, schema_file=path)
+    validator = file._get_validator(path)
+    assert file.validate_schema({'item': {'n': 2}}, schema_file=path)
+    assert file._get_validator(path) is validator
+
+    assert file.validate_schema(
+        {'item': {'n': 'x'}}, schema_file=path) is False
+    with pytest.raises(Exception, match="'x' is not of type 'integer'"):
+        file.validate_schema(
+            {'item': {'n': 'x'}}, schema_file=path, raise_ex=True)
@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+import time
+
+
+HELPERS_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)),
+    '..',
+    '..',
+    'Local',
+    'helpers'
+)
+if HELPERS_DIR not in sys.path:
+    sys.path.append(HELPERS_DIR)
+
+
+from scheduler import Scheduler  # noqa: E402
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_scheduler_runs_in_due_order():
+    scheduler = Scheduler()
+    now = time.time()
+    ran = []
+    scheduler.schedule(now + 0.2, ran.append, 'later')
+    scheduler.schedule(now - 3600, ran.append, 'overdue')
+    scheduler.schedule(now + 0.1, ran.append, 'soon')
+    cancelled = scheduler.schedule(now + 0.15, ran.append, 'cancelled')
+    scheduler.cancel(cancelled)
+
+    _wait_for(lambda: len(ran) == 3)
+    assert ran == ['overdue', 'soon', 'later']
+    assert scheduler.pending() == []
+
+
+def test_scheduler_fires_at_due_time():
+    scheduler = Scheduler()
+    fired = threading.Event()
+    due = time.time() + 0.3
+    times = []
+
+    def job():
+        times.append(time.time())
+        fired.set()
+
+    scheduler.schedule(due + 3600, job)
+    job_ = scheduler.schedule(due, job)
+    assert scheduler.pending()[0] is job_
+    assert fired.wait(5)
+    assert due <= times[0] < due + 0.25
+    assert len(scheduler.pending()) == 1
+
+
+def test_scheduler_isolates_failures():
+    scheduler = Scheduler()
+    ran = []
+
+    def fail():
+        raise ValueError('boom')
+
+    scheduler.schedule(0, fail)
+    scheduler.schedule(1, ran.append, 'ok')
+    _wait_for(lambda: ran)
+    assert scheduler.stats == {'runs': 1, 'failures': 1}
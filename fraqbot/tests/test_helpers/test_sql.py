@@ -0,0 +1,805 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+
+HELPERS_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)),
+    '..',
+    '..',
+    'Local',
+    'helpers'
+)
+if HELPERS_DIR not in sys.path:
+    sys.path.append(HELPERS_DIR)
+
+TABLES_DIR = os.path.join(HELPERS_DIR, '..', 'data', 'tables')
+
+
+import file  # noqa: E402
+import sql  # noqa: E402
+
+
+def _ledger_tables():
+    tables = {}
+    for name in ['balance', 'transaction']:
+        tables.update(file.load_file(os.path.join(TABLES_DIR, f'{name}.yaml')))
+
+    return tables
+
+
+def _ledger_db(tmp_path, **kwargs):
+    return sql.DB('sqlite', tmp_path / 'tx.sqlite', _ledger_tables(), **kwargs)
+
+
+def _hold_writer(writer):
+    # Park the writer thread on an event so submitted writes queue up
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold(session):
+        held.set()
+        release.wait(5)
+
+    writer.submit(hold)
+    held.wait(5)
+
+    return release
+
+
+def _wait_for_depth(writer, depth):
+    for _ in range(500):
+        if writer.queue.qsize() >= depth:
+            return
+
+        time.sleep(0.01)
+
+    raise AssertionError(f'Write queue never reached {depth}')
+
+
+def test_transfer(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.balance.upsert({'user': 'bob', 'balance': 10})
+
+    assert db.transfer('bob', 'larry', 4, 'thanks') is True
+    assert db.balance.get('bob', return_field_value='balance') == 6
+    assert db.balance.get('larry', return_field_value='balance') == 4
+
+    tx = db.transaction.query(limit=1, sort='id,desc')
+    assert tx['payer_id'] == 'bob'
+    assert tx['payee_id'] == 'larry'
+    assert tx['amount'] == 4
+    assert tx['memo'] == 'thanks'
+
+
+def test_transfer_nsf(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.balance.upsert({'user': 'bob', 'balance': 3})
+
+    assert db.transfer('bob', 'larry', 4) == 'NSF'
+    assert db.transfer('nobody', 'larry', 1) == 'NSF'
+    assert db.balance.get('bob', return_field_value='balance') == 3
+    assert db.balance.get('larry') is None
+    assert db.transaction.count() == 0
+
+
+def test_transfer_mint(tmp_path):
+    db = _ledger_db(tmp_path)
+
+    assert db.transfer('None', 'pool', 250, 'deposit', 123, mint=True)
+    assert db.balance.get('None') is None
+    assert db.balance.get('pool', return_field_value='balance') == 250
+    assert db.transaction.query(
+        limit=1, return_field_value='tx_timestamp') == 123
+
+
+def test_get_db_shared(tmp_path):
+    calls = []
+
+    def config():
+        calls.append(True)
+        return {'tables': _ledger_tables()}
+
+    path = tmp_path / 'tx.sqlite'
+    db = sql.get_db('sqlite', path, config)
+
+    assert sql.get_db('sqlite', str(path), config) is db
+    assert sql.get_db('sqlite', tmp_path / '.' / 'tx.sqlite', config) is db
+    assert len(calls) == 1
+    assert sql.get_db('sqlite', tmp_path / 'other.sqlite', config) is not db
+    assert len(calls) == 2
+
+
+def test_engine_pragmas(tmp_path):
+    pragmas = {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -8000,
+        'mmap_size': 1048576,
+        'busy_timeout': 2500
+    }
+    db = sql.DB(
+        'sqlite',
+        tmp_path / 'tx.sqlite',
+        _ledger_tables(),
+        engine={'pragmas': pragmas}
+    )
+
+    with db.engine.connect() as conn:
+        for key, expected in [
+            ('journal_mode', 'wal'),
+            ('synchronous', 1),
+            ('cache_size', -8000),
+            ('busy_timeout', 2500)
+        ]:
+            value = conn.exec_driver_sql(f'PRAGMA {key}').scalar()
+            assert value == expected
+
+
+def test_engine_pragmas_invalid(tmp_path):
+    with pytest.raises(Exception, match='Schema validation error'):
+        sql.DB(
+            'sqlite',
+            tmp_path / 'tx.sqlite',
+            _ledger_tables(),
+            engine={'pragmas': {'journal_mode': 'wal; DROP TABLE balance'}}
+        )
+
+
+def test_table_indexes(tmp_path):
+    path = tmp_path / 'tx.sqlite'
+    columns = [
+        {'name': 'id', 'type': 'int', 'kwargs': {'primary_key': True}},
+        {'name': 'group_id', 'type': 'string', 'kwargs': {'index': True}},
+        {'name': 'payee_id', 'type': 'string'},
+        {'name': 'memo', 'type': 'string'}
+    ]
+    db = sql.DB('sqlite', path, {'escrow': columns})
+    indexes = sql.inspect(db.engine).get_indexes('escrow')
+    assert [i['column_names'] for i in indexes] == [['group_id']]
+    assert db.escrow.fields == ['id', 'group_id', 'payee_id', 'memo']
+
+    # Adding indexes to the config of an existing table creates them
+    columns += [
+        {'name': 'ix_escrow_payee_memo', 'index': ['payee_id', 'memo']},
+        {'name': 'ux_escrow_memo', 'index': ['memo'], 'unique': True}
+    ]
+    db = sql.DB('sqlite', path, {'escrow': columns})
+    indexes = {
+        i['name']: i
+        for i in sql.inspect(db.engine).get_indexes('escrow')
+    }
+    assert indexes['ix_escrow_payee_memo']['column_names'] == [
+        'payee_id', 'memo']
+    assert indexes['ux_escrow_memo']['unique']
+    assert db.escrow.fields == ['id', 'group_id', 'payee_id', 'memo']
+
+
+def test_query_statement_cache(tmp_path):
+    db = _ledger_db(tmp_path)
+    for user, balance in [('U1', 5), ('U2', 10), ('U3', 15), ('pool', 99)]:
+        db.balance.upsert({'user': user, 'balance': balance})
+
+    def users(**kwargs):
+        return [
+            b['user'] for b in db.balance.query(sort='user,asc', **kwargs)
+        ]
+
+    _filter = {'user__op': {'startswith': 'U', 'notin_': ['U2']}}
+    assert users(_filter=_filter) == ['U1', 'U3']
+    assert len(db.balance.statements) == 1
+
+    # Same shape, new values: served from the cache with the new params
+    _filter = {'user__op': {'startswith': 'p', 'notin_': ['U1', 'U3']}}
+    assert users(_filter=_filter) == ['pool']
+    assert users(_filter={'balance__op': {'__ge__': 10}}) == [
+        'U2', 'U3', 'pool']
+    assert users(_filter={'balance__op': {'__ge__': 15}}) == ['U3', 'pool']
+    assert users(_filter={'user': 'U2'}) == ['U2']
+    assert users(_filter={'user': None}) == []
+    assert len(db.balance.statements) == 4
+
+    assert db.balance.query(
+        _filter={'user': 'U3'},
+        limit=1,
+        return_field_value='balance'
+    ) == 15
+    assert db.balance.query(_filter={'user': 'nobody'}, limit=1) == {}
+
+
+def test_query_invalid_not_cached(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.balance.upsert({'user': 'U1', 'balance': 5})
+
+    assert db.balance.query(fields='user,bogus') == [{'user': 'U1'}]
+    assert db.balance.statements == {}
+
+    with pytest.raises(Exception, match='bogus is not a valid field'):
+        db.balance.query(_filter={'bogus': 1}, raise_ex=True)
+
+
+def test_errors_per_thread(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.balance.upsert({'user': 'U1', 'balance': 5})
+
+    # A pending error in one thread doesn't fail or clear another's call
+    db.balance.errors.append('pending')
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        db.balance.query(_filter={'user': 'U1'}, raise_ex=True)))
+    thread.start()
+    thread.join()
+
+    assert results == [[{'user': 'U1', 'balance': 5, 'version': 0}]]
+    assert len(db.balance.statements) == 1
+    assert db.balance.errors == ['pending']
+    with pytest.raises(Exception, match='pending'):
+        db.balance._error('query', raise_ex=True)
+
+    assert db.balance.errors == []
+
+
+def test_bulk_upsert(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.balance.upsert({'user': 'U1', 'balance': 1})
+
+    records = [{'user': f'U{i}', 'balance': i * 10} for i in range(1, 8)]
+    records.append({'user': 'U2', 'balance': 5})
+    result = db.balance.bulk_upsert(records, batch_size=3)
+    assert result == {'inserted': 6, 'updated': 2}
+    assert db.balance.get('U1', return_field_value='balance') == 10
+    assert db.balance.get('U2', return_field_value='balance') == 5
+    assert db.balance.count() == 7
+
+    # Rows without a primary key are always inserted
+    result = db.transaction.bulk_upsert([
+        {'tx_timestamp': 1, 'payer_id': 'a', 'payee_id': 'b', 'amount': 1},
+        {'tx_timestamp': 2, 'payer_id': 'b', 'payee_id': 'a', 'amount': 1,
+         'memo': 'back'}
+    ])
+    assert result == {'inserted': 2, 'updated': 0}
+
+    record = db.transaction.get(2)
+    record['memo'] = 'back again'
+    result = db.transaction.bulk_upsert([record])
+    assert result == {'inserted': 0, 'updated': 1}
+    assert db.transaction.get(2, return_field_value='memo') == 'back again'
+
+
+def test_bulk_upsert_rolls_back(tmp_path):
+    db = _ledger_db(tmp_path)
+    records = [
+        {'user': 'U1', 'balance': 1},
+        {'user': 'U2', 'balance': None}
+    ]
+
+    assert db.balance.bulk_upsert(records, batch_size=1) is None
+    assert db.balance.count() == 0
+
+
+def test_iter_query(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.balance.bulk_upsert([
+        {'user': f'U{i:04}', 'balance': i}
+        for i in range(1000)
+    ])
+    kwargs = {
+        'fields': ['user', 'balance'],
+        '_filter': {'balance__op': {'__ge__': 250}},
+        'sort': 'balance,desc'
+    }
+
+    rows = db.balance.iter_query(chunk_size=100, **kwargs)
+    assert next(rows) == {'user': 'U0999', 'balance': 999}
+    assert list(rows) == db.balance.query(**kwargs)[1:]
+    assert len(list(db.balance.iter_query(limit=10))) == 10
+
+    # Abandoned iterators release their connection
+    rows = db.balance.iter_query()
+    next(rows)
+    rows.close()
+    assert db.engine.pool.checkedout() == 0
+
+
+def test_connection_pool(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.balance.query()
+    db.balance.query()
+
+    assert isinstance(db.engine.pool, sql.QueuePool)
+    assert db.engine.pool.checkedin() == 1
+
+
+def test_aggregate(tmp_path):
+    db = _ledger_db(tmp_path)
+    day = 86400
+    db.transaction.bulk_insert([
+        {'tx_timestamp': ts, 'payer_id': payer, 'payee_id': payee,
+         'amount': amount, 'memo': None}
+        for ts, payer, payee, amount in [
+            (day + 1, 'U1', 'U2', 5),
+            (day + 2, 'U1', 'U3', 10),
+            (day * 2 + 5, 'U2', 'U3', 1),
+            (day * 2 + 6, 'pool', 'U3', 100),
+            (day * 3, 'pool', 'U2', 50)
+        ]
+    ])
+
+    totals = db.transaction.aggregate(
+        group_by='payee_id',
+        metrics={'total': ('sum', 'amount'), 'txs': ('count', '*')},
+        sort='total,desc'
+    )
+    assert totals == [
+        {'payee_id': 'U3', 'total': 111, 'txs': 3},
+        {'payee_id': 'U2', 'total': 55, 'txs': 2}
+    ]
+
+    tips = db.transaction.aggregate(
+        group_by={'field': 'tx_timestamp', 'bucket': day, 'name': 'day'},
+        metrics={'tips': ('count', 'id'), 'largest': ('max', 'amount')},
+        _filter={'payer_id__op': {'startswith': 'U'}},
+        sort='day,asc'
+    )
+    assert tips == [
+        {'day': day, 'tips': 2, 'largest': 10},
+        {'day': day * 2, 'tips': 1, 'largest': 1}
+    ]
+
+    big = db.transaction.aggregate(
+        group_by=['payer_id'],
+        metrics={'total': ('sum', 'amount')},
+        having={'total__op': {'__gt__': 15}},
+        limit=1
+    )
+    assert big == [{'payer_id': 'pool', 'total': 150}]
+    assert db.transaction.aggregate(
+        metrics={'total': ('sum', 'amount')}) == [{'total': 166}]
+
+
+def test_aggregate_invalid(tmp_path):
+    db = _ledger_db(tmp_path)
+
+    metrics = {'x': ('median', 'amount')}
+    assert db.transaction.aggregate(metrics=metrics) is None
+    for metrics in ({'n': 'count'}, {'n': ['count']}, {'n': [1, 2]}, 'n'):
+        assert db.transaction.aggregate(
+            group_by='payer_id', metrics=metrics) is None
+
+    with pytest.raises(Exception, match='Invalid group by'):
+        db.transaction.aggregate(
+            group_by='bogus',
+            metrics={'x': ('sum', 'amount')},
+            raise_ex=True
+        )
+
+
+def test_write_queue_batches(tmp_path):
+    db = _ledger_db(tmp_path, engine={'write_queue': {'max_batch': 50}})
+    db.balance.upsert({'user': 'bank', 'balance': 100})
+    release = _hold_writer(db.writer)
+    results = []
+
+    def pay(user):
+        results.append(db.transfer('bank', user, 10))
+
+    threads = [
+        threading.Thread(target=pay, args=(f'U{i}',))
+        for i in range(12)
+    ]
+    for thread in threads:
+        thread.start()
+
+    _wait_for_depth(db.writer, 12)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    # Only 10 payments can be covered, the rest fail the funds check
+    assert sorted(results, key=str) == ['NSF'] * 2 + [True] * 10
+    assert db.balance.get('bank', return_field_value='balance') == 0
+    assert db.transaction.count() == 10
+
+    metrics = db.writer.metrics()
+    assert metrics['max_batch'] == 12
+    assert metrics['depth'] == 0
+    assert metrics['operations'] == metrics['commits'] + 11
+
+
+def test_write_queue_isolates_failures(tmp_path):
+    db = _ledger_db(tmp_path, engine={'write_queue': {}})
+    release = _hold_writer(db.writer)
+
+    def add(user):
+        def _add(session):
+            session.add(db.balance.table(user=user, balance=1))
+            return user
+
+        return _add
+
+    def bad(session):
+        raise ValueError('bad write')
+
+    futures = [
+        db.writer.submit(add('U1')),
+        db.writer.submit(bad),
+        db.writer.submit(add('U2'))
+    ]
+    release.set()
+
+    with pytest.raises(ValueError, match='bad write'):
+        futures[1].result()
+
+    assert futures[0].result() == 'U1'
+    assert futures[2].result() == 'U2'
+    assert db.balance.count() == 2
+    assert db.writer.metrics()['failures'] == 1
+
+    # Errors still surface through the Table methods
+    assert db.balance.upsert({'user': 'U3', 'balance': None}) is False
+    assert db.balance.count() == 2
+
+
+def test_write_queue_mixed_orm_and_core(tmp_path):
+    db = _ledger_db(tmp_path, engine={'write_queue': {}})
+    db.balance.upsert({'user': 'bank', 'balance': 50})
+    release = _hold_writer(db.writer)
+
+    # An ORM upsert followed by a Core transfer on the same row, one batch
+    upsert = threading.Thread(
+        target=db.balance.upsert, args=({'user': 'bank', 'balance': 100},))
+    upsert.start()
+    _wait_for_depth(db.writer, 1)
+    results = []
+    transfer = threading.Thread(
+        target=lambda: results.append(db.transfer('bank', 'U1', 10)))
+    transfer.start()
+    _wait_for_depth(db.writer, 2)
+    release.set()
+    upsert.join()
+    transfer.join()
+
+    assert results == [True]
+    assert db.balance.get('bank', return_field_value='balance') == 90
+    assert db.balance.get('U1', return_field_value='balance') == 10
+    assert db.writer.metrics()['last_batch'] == 2
+
+
+def test_add_counts(tmp_path):
+    tables = file.load_file(os.path.join(TABLES_DIR, 'participant.yaml'))
+    db = sql.DB('sqlite', tmp_path / 'tx.sqlite', tables)
+    assert db.participant.add_counts([
+        {'pool_id': 1, 'user': 'U1', 'messages': 2},
+        {'pool_id': 1, 'user': 'U2', 'messages': 1}
+    ], 'messages')
+    assert db.participant.latest(return_field_value='messages') == 1
+    assert db.participant.add_counts([
+        {'pool_id': 1, 'user': 'U1', 'messages': 3},
+        {'pool_id': 2, 'user': 'U1', 'messages': 1}
+    ], 'messages')
+    assert db.participant.add_counts([], 'messages')
+    assert db.participant.query(sort='pool_id', compact=True) == [
+        (1, 'U1', 5), (1, 'U2', 1), (2, 'U1', 1)]
+    assert not db.participant.add_counts('U1', 'messages')
+
+
+def test_set_balance_versions(tmp_path):
+    db = _ledger_db(tmp_path)
+
+    assert db.set_balance('U1', 10, version=0) is True
+    assert db.set_balance('U1', 20, version=0) == 'CONFLICT'
+    assert db.balance.get('U1') == {'user': 'U1', 'balance': 10, 'version': 1}
+
+    assert db.transfer('U1', 'U2', 4) is True
+    assert db.balance.get('U1', return_field_value='version') == 2
+    assert db.balance.get('U2', return_field_value='version') == 1
+    assert db.set_balance('U1', 0, version=1) == 'CONFLICT'
+    assert db.set_balance('U1', 0, version=2) is True
+
+    # Without a version the write always applies
+    assert db.set_balance('U1', 7) is True
+    assert db.set_balance('U3', 7) is True
+    assert db.balance.get('U1', return_field_value='version') == 4
+
+
+def test_balance_version_migration(tmp_path):
+    path = tmp_path / 'tx.sqlite'
+    tables = _ledger_tables()
+    tables['balance'] = [
+        c for c in tables['balance'] if c['name'] != 'version']
+    db = sql.DB('sqlite', path, tables)
+    db.balance.upsert({'user': 'U1', 'balance': 5})
+
+    migrations = {
+        'balance': [{'id': 'add_version_field', 'script': 'balance.py'}]}
+    db = sql.DB('sqlite', path, _ledger_tables(), migrations=migrations)
+    assert db.get_migration_state('balance-add_version_field')
+    assert db.balance.get('U1') == {'user': 'U1', 'balance': 5, 'version': 0}
+    assert db.set_balance('U1', 6, version=0) is True
+
+
+def test_escrow_paid_migration(tmp_path):
+    path = tmp_path / 'tx.sqlite'
+    tables = {}
+    for name in ['escrow', 'pool_history']:
+        tables.update(file.load_file(os.path.join(TABLES_DIR, f'{name}.yaml')))
+
+    legacy = dict(tables)
+    legacy['escrow'] = [c for c in tables['escrow'] if c['name'] != 'paid']
+    db = sql.DB('sqlite', path, legacy)
+    db.pool_history.bulk_insert([
+        {'id': i, 'fillup_ts': i, 'next_fillup_ts': i + 1, 'amount': 1}
+        for i in (1, 2)
+    ])
+    db.escrow.bulk_insert([
+        {'escrow_group_id': str(i % 2 + 1), 'tx_timestamp': i,
+         'payer_id': 'escrow', 'payee_id': 'U1', 'amount': 1}
+        for i in range(10)
+    ])
+
+    migrations = {'escrow': [{'id': 'add_paid_field', 'script': 'escrow.py'}]}
+    db = sql.DB('sqlite', path, tables, migrations=migrations)
+    assert db.get_migration_state('escrow-add_paid_field')
+    paid = db.escrow.aggregate(
+        group_by=['escrow_group_id', 'paid'],
+        metrics={'n': ('count', '*')},
+        sort='escrow_group_id,asc'
+    )
+    assert paid == [
+        {'escrow_group_id': '1', 'paid': True, 'n': 5},
+        {'escrow_group_id': '2', 'paid': False, 'n': 5}
+    ]
+
+
+def test_copy_table(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.transaction.bulk_insert([
+        {'tx_timestamp': i, 'payer_id': 'U1', 'payee_id': f'U{i % 7}',
+         'amount': i, 'memo': 'tip'}
+        for i in range(1000)
+    ])
+    columns = [
+        c for c in _ledger_tables()['transaction']
+        if c['name'] != 'memo' and 'memo' not in c.get('index', [])
+    ]
+    columns.append({'name': 'ix_transaction_amount', 'index': ['amount']})
+
+    def fail(row):
+        if row['id'] > 500:
+            raise ValueError('bad row')
+
+        return row
+
+    with pytest.raises(ValueError):
+        db.copy_table('transaction', columns, fail, chunk_size=64)
+
+    assert db.transaction.count() == 1000
+
+    def double(row):
+        row['amount'] *= 2
+        return row
+
+    table = db.copy_table('transaction', columns, double, chunk_size=64)
+    assert table.count() == 1000
+    assert table.fields == [
+        'id', 'tx_timestamp', 'payer_id', 'payee_id', 'amount']
+    assert table.get(11) == {
+        'id': 11, 'tx_timestamp': 10, 'payer_id': 'U1', 'payee_id': 'U3',
+        'amount': 20}
+
+    inspector = sql.inspect(db.engine)
+    assert sorted(inspector.get_table_names()) == [
+        'balance', 'migration', 'transaction']
+    assert 'ix_transaction_amount' in [
+        i['name'] for i in inspector.get_indexes('transaction')]
+
+
+def test_seed_streaming(tmp_path):
+    path = tmp_path / 'tx.csv'
+    lines = ['Timestamp|Payer|Payee|Amount|Memo']
+    lines += [f'{i}.5|U{i % 3}|U{i % 5}|{i}|None' for i in range(10)]
+    lines[4] = lines[4].replace('None', 'thanks')
+    path.write_text('\n'.join(lines))
+    balances = tmp_path / 'balances.json'
+    balances.write_text('{"U1": 5, "U2": 10, "U3": 15}')
+    seeds = {
+        'transaction': {
+            'file': str(path),
+            'load_kwargs': {'f_type': 'csv', 'delimiter': '|'},
+            'transform': (
+                '[].{tx_timestamp: to_number(Timestamp), payer_id: Payer, '
+                'payee_id: Payee, amount: to_number(Amount), '
+                'memo: string_or_null(Memo)}'
+            ),
+            'chunk_size': 3
+        },
+        'balance': {
+            'file': str(balances),
+            'transform': "key_val_to_fields(@, 'user', 'balance')",
+            'chunk_size': 2
+        }
+    }
+    db = sql.DB('sqlite', tmp_path / 'tx.sqlite', _ledger_tables(), seeds)
+
+    assert db.transaction.count() == 10
+    assert db.transaction.get(4) == {
+        'id': 4, 'tx_timestamp': 3.5, 'payer_id': 'U0', 'payee_id': 'U3',
+        'amount': 3, 'memo': 'thanks'}
+    assert db.transaction.get(5, return_field_value='memo') is None
+    assert db.balance.query(fields='user,balance', sort='user,asc') == [
+        {'user': 'U1', 'balance': 5},
+        {'user': 'U2', 'balance': 10},
+        {'user': 'U3', 'balance': 15}
+    ]
+
+
+def test_seed_rolls_back(tmp_path):
+    records = [{'user': f'U{i}', 'balance': i} for i in range(10)]
+    records[7]['balance'] = None
+    db = _ledger_db(tmp_path)
+
+    assert db.process_seeds(
+        {'balance': {'data': records, 'chunk_size': 2}}) is False
+    assert db.balance.count() == 0
+
+
+def test_seed_optional_columns(tmp_path):
+    records = [
+        {'tx_timestamp': i, 'payer_id': 'U1', 'payee_id': 'U2', 'amount': 1}
+        for i in range(5)
+    ]
+    records[0]['memo'] = 'first'
+    records[3]['memo'] = 'fourth'
+    db = _ledger_db(tmp_path)
+
+    assert db.process_seeds({'transaction': {'data': records}})
+    assert [
+        t['memo'] for t in db.transaction.query(sort='id,asc')
+    ] == ['first', None, None, 'fourth', None]
+
+    # Unsupported load kwargs fail the schema check instead of being dropped
+    seeds = {'balance': {'file': 'b.csv', 'load_kwargs': {'encoding': 'x'}}}
+    with pytest.raises(Exception):
+        sql.DB('sqlite', tmp_path / 'b.sqlite', _ledger_tables(), seeds)
+
+
+def test_compact_rows(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.transfer('None', 'U1', 5, 'mint', 100, mint=True)
+
+    row = db.balance.get('U1', compact=True)
+    assert row == ('U1', 5, 1)
+    assert (row.user, row.balance) == ('U1', 5)
+    with pytest.raises(AttributeError):
+        row.balance = 10
+
+    assert db.balance.get('U1', 'balance', compact=True) == (5, )
+    assert db.balance.get(
+        'U1', return_field_value='balance', compact=True) == 5
+    assert db.balance.get('nobody', compact=True) is None
+    tx = db.transaction.get(1, compact=True)
+    assert tx._asdict() == db.transaction.get(1)
+
+    rows = db.balance.query(compact=True)
+    assert rows == [row]
+    assert type(rows[0]) is type(row)
+    assert list(db.balance.iter_query(fields='user', compact=True)) == [
+        ('U1', )]
+    assert db.balance.query(
+        _filter={'user': 'nobody'}, limit=1, compact=True) is None
+
+
+def _measure(fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    rows = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return rows, elapsed, peak
+
+
+def test_compact_rows_benchmark(tmp_path):
+    db = _ledger_db(tmp_path)
+    n = 100000
+    db.transaction.bulk_upsert([
+        {'tx_timestamp': i, 'payer_id': f'U{i % 50}',
+         'payee_id': f'U{i % 70}', 'amount': i % 20, 'memo': 'tip'}
+        for i in range(n)
+    ], batch_size=5000)
+    db.transaction.query(limit=1)
+    db.transaction.query(limit=1, compact=True)
+
+    dicts, dict_time, dict_peak = _measure(lambda: db.transaction.query())
+    del dicts
+    rows, compact_time, compact_peak = _measure(
+        lambda: db.transaction.query(compact=True))
+    assert len(rows) == n
+
+    print(f'\n{n} rows: dicts {dict_peak / n:.0f} B/row '
+          f'{dict_time:.3f}s, compact {compact_peak / n:.0f} B/row '
+          f'{compact_time:.3f}s')
+    assert compact_peak < dict_peak * 0.75
+
+
+def test_keyset_pagination(tmp_path):
+    db = _ledger_db(tmp_path)
+    db.transaction.bulk_insert([
+        {'tx_timestamp': i // 4, 'payer_id': f'U{i % 3}', 'payee_id': 'U9',
+         'amount': i, 'memo': None}
+        for i in range(50)
+    ])
+
+    for sort in ['tx_timestamp,desc', 'tx_timestamp,asc', None]:
+        kwargs = {'fields': 'id', '_filter': {'payer_id': 'U1'}, 'sort': sort}
+        pages = []
+        after = None
+        while True:
+            page = db.transaction.query(limit=4, after=after, **kwargs)
+            if not page:
+                break
+
+            pages.append(page)
+            after = page[-1]['id']
+
+        expected = db.transaction.query(**kwargs)
+        assert [len(p) for p in pages] == [4, 4, 4, 4, 1]
+        assert [r for p in pages for r in p] == expected
+
+    rows = db.transaction.iter_query(
+        fields='id', sort='id,desc', after=10, compact=True)
+    assert [r.id for r in rows] == list(range(9, 0, -1))
+
+
+def test_latest_cache(tmp_path):
+    db = _ledger_db(tmp_path)
+    selects = []
+
+    @sql.event.listens_for(db.engine, 'before_cursor_execute')
+    def count_selects(conn, cursor, statement, *args):
+        if statement.startswith('SELECT'):
+            selects.append(statement)
+
+    assert db.transaction.latest() == {}
+    assert db.transaction.latest(3) == []
+
+    db.transaction.bulk_insert([
+        {'tx_timestamp': i, 'payer_id': 'U1', 'payee_id': 'U2', 'amount': i}
+        for i in range(1, 21)
+    ])
+    selects.clear()
+
+    latest = db.transaction.latest()
+    assert latest['id'] == 20
+    assert db.transaction.latest(return_field_value='amount') == 20
+    assert [r['id'] for r in db.transaction.latest(3)] == [20, 19, 18]
+    assert len(selects) == 1
+
+    # Callers get copies
+    latest['amount'] = 0
+    assert db.transaction.latest(return_field_value='amount') == 20
+
+    # Writes through the table refresh it
+    latest['amount'] = 99
+    db.transaction.upsert(latest)
+    assert db.transaction.latest(return_field_value='amount') == 99
+    assert len(selects) == 3
+
+    # More rows than cached are read from the DB and then kept
+    assert len(db.transaction.latest(15)) == 15
+    assert len(db.transaction.latest(12)) == 12
+    assert len(selects) == 4
+
+    # So do ledger writes made through the DB
+    assert db.transfer('U1', 'U2', 5, mint=True) is True
+    assert db.transaction.latest(return_field_value='id') == 21
+    assert db.balance.latest(return_field_value='balance') == 5
+    assert db.set_balance('U2', 7) is True
+    assert db.balance.latest(return_field_value='balance') == 7